@@ -0,0 +1,136 @@
+import io
+import gc
+import json
+import shutil
+import argparse
+import tempfile
+
+from pathlib import Path
+from contextlib import nullcontext, redirect_stdout
+from src.get_climoFiles import GetClimo
+from src.profiling import StageProfiler
+from src.utils import exec_shell, start_scheduler
+from benchmarks.synthetic import write_case
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def parse_arguments():
+    """Parses command-line arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark the climo pipeline on synthetic h0 files.")
+
+    parser.add_argument("-m", "--model", help="Synthetic model output (eam | scream)", default="eam")
+    parser.add_argument("-y", "--years", help="Simulated years", type=int, default=2)
+    parser.add_argument("--ncol", help="Number of columns", type=int, default=21600)
+    parser.add_argument("--lev", help="Number of levels", type=int, default=72)
+    parser.add_argument("--nvars", help="Number of additional 3D variables", type=int, default=4)
+    parser.add_argument("--constituents", help="Size of the packed constituent dimension (scream, at least 40)", type=int, default=None)
+    parser.add_argument("-t", "--time_freq", help="Comma separated time frequencies to run", default="ann,sea,mon,all")
+    parser.add_argument("-b", "--backend", help="Reduction backend (dask | streaming)", default="dask")
+    parser.add_argument("-k", "--kernel", help="Weighted mean kernel (xarray | numpy | numba)", default="xarray")
+    parser.add_argument("--scheduler", help="Dask scheduler (threads | processes | distributed | synchronous)", default="threads")
+    parser.add_argument("--workers", help="Number of dask workers", type=int, default=None)
+    parser.add_argument("--data-dir", help="Directory of the synthetic files (reused between runs)", default=None)
+    parser.add_argument("--label", help="Name of the stored results (default: current git commit)", default=None)
+    parser.add_argument("--compare", help="Label of earlier results to compare against", default=None)
+    parser.add_argument("--verbose", help="Show the output of genclimo", action="store_true")
+
+    return parser.parse_args()
+
+
+def run_mode(args, indir, ts):
+    """
+    Run the full pipeline for one time frequency and return its timings, throughput and peak memory.
+    """
+    outdir = Path(tempfile.mkdtemp(prefix="genclimo_bench_"))
+    climo = GetClimo(
+        case="bench",
+        start="0001",
+        end=f"{args.years:04d}",
+        path=indir,
+        outpath=outdir,
+        ts=ts,
+        mod=args.model,
+        backend=args.backend,
+        kernel=args.kernel,
+        parallel=args.scheduler != "threads" or args.workers is not None,
+    )
+
+    profiler = StageProfiler()
+    try:
+        with profiler.stage(ts), (nullcontext() if args.verbose else redirect_stdout(io.StringIO())):
+            climo.get_nc()
+    finally:
+        shutil.rmtree(outdir)
+
+    stats = profiler.stages[ts]
+    input_bytes = sum(f.stat().st_size for f in Path(indir).glob(f"bench.{args.model}.h0.*.nc"))
+    gc.collect()
+
+    return {
+        "wall_s": stats["wall_s"],
+        "gb_per_s": input_bytes / 1e9 / stats["wall_s"],
+        "s_per_year": stats["wall_s"] / args.years,
+        "peak_rss_bytes": stats["peak_rss_bytes"],
+        "stages": {name: round(stage["wall_s"], 4) for name, stage in climo.profiler.stages.items()},
+    }
+
+
+def compare(results, label):
+    """
+    Print the wall time and peak memory of each time frequency relative to earlier results.
+    """
+    with open(RESULTS_DIR / f"{label}.json") as file:
+        base = json.load(file)
+
+    if base["config"] != results["config"]:
+        print("\nWarning: the configurations differ:\n", base["config"], "\n", results["config"])
+
+    print(f"\nCompared to {label}:")
+    for ts, result in results["results"].items():
+        if ts not in base["results"]:
+            continue
+        wall = result["wall_s"] / base["results"][ts]["wall_s"]
+        memory = result["peak_rss_bytes"] / base["results"][ts]["peak_rss_bytes"]
+        print(f"{ts:>4}: wall x{wall:.2f} | peak memory x{memory:.2f}")
+
+
+def main():
+    args = parse_arguments()
+    config = {
+        key: getattr(args, key)
+        for key in ["model", "years", "ncol", "lev", "nvars", "constituents", "backend", "kernel", "scheduler", "workers"]
+    }
+
+    name = f"{args.model}_{args.years}y_{args.ncol}c_{args.lev}l_{args.nvars}v_{args.constituents or 0}k"
+    indir = Path(args.data_dir or Path(tempfile.gettempdir()) / "genclimo_bench") / name
+    print("\nWriting synthetic files to:", str(indir))
+    write_case(indir, "bench", args.model, args.years, args.ncol, args.lev, args.nvars, args.constituents)
+
+    client = start_scheduler(args.scheduler, args.workers)
+    try:
+        results = {}
+        for ts in args.time_freq.split(","):
+            results[ts] = run_mode(args, indir, ts)
+            print(
+                f"{ts:>4}: {results[ts]['wall_s']:.2f} s | {results[ts]['gb_per_s']:.3f} GB/s"
+                f" | {results[ts]['s_per_year']:.2f} s/year | peak {results[ts]['peak_rss_bytes'] / 1e9:.2f} GB"
+            )
+    finally:
+        if client is not None:
+            client.shutdown()
+
+    label = args.label or exec_shell("git rev-parse --short HEAD").strip()
+    results = {"label": label, "config": config, "results": results}
+
+    RESULTS_DIR.mkdir(exist_ok=True)
+    with open(RESULTS_DIR / f"{label}.json", "w") as file:
+        json.dump(results, file, indent=2)
+    print("\nSaved results:", str(RESULTS_DIR / f"{label}.json"))
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import time
+import argparse
+import tempfile
+import numpy as np
+import xarray as xr
+
+from pathlib import Path
+from src.utils import nc_encoding
+
+
+def parse_arguments():
+    """Parses command-line arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark the write time and size of climo file encodings.")
+
+    parser.add_argument("--ncol", help="Number of columns", type=int, default=21600)
+    parser.add_argument("--lev", help="Number of levels", type=int, default=72)
+    parser.add_argument("--nvars", help="Number of 3D variables", type=int, default=20)
+    parser.add_argument("-r", "--repeat", help="Repetitions per encoding", type=int, default=3)
+
+    return parser.parse_args()
+
+
+def synthetic_climo(ncol, lev, nvars):
+    """
+    A float64 climo of smooth float32 fields, as produced by the weighted means.
+    """
+    rng = np.random.default_rng(0)
+    lat = np.linspace(-np.pi / 2, np.pi / 2, ncol)
+    lon = rng.uniform(0, 2 * np.pi, ncol)
+    levels = np.linspace(0, 1, lev)[:, None]
+
+    variables = {}
+    for i in range(nvars):
+        field = np.cos(lat) * (1 + levels) * 250 + 10 * np.sin((i + 1) * lon) * levels
+        field += rng.normal(0, 0.1, field.shape)
+        variables[f"V{i}"] = (("lev", "ncol"), field.astype(np.float32).astype(np.float64))
+
+    data = xr.Dataset(variables, coords={"lev": np.linspace(1, 1000, lev)})
+    dtypes = {var: np.dtype(np.float32) for var in data.data_vars}
+    return data, dtypes
+
+
+def main():
+    args = parse_arguments()
+    data, dtypes = synthetic_climo(args.ncol, args.lev, args.nvars)
+    print(f"\nClimo: {data.nbytes / 1e6:.0f} MB in memory, {args.nvars} variables")
+
+    encodings = [("none", 0, False, None), ("none", 0, False, dtypes)]
+    # netCDF4 only applies the shuffle filter with zlib
+    for compression, shuffles in [("zlib", [True, False]), ("zstd", [False])]:
+        for complevel in [1, 4, 9]:
+            for shuffle in shuffles:
+                encodings.append((compression, complevel, shuffle, dtypes))
+    encodings.append(("zlib", 1, True, None))
+
+    filepath = Path(tempfile.mkdtemp()) / "climo.nc"
+    for compression, complevel, shuffle, out_dtypes in encodings:
+        encoding = nc_encoding(data, compression, complevel, shuffle, out_dtypes)
+
+        timings = []
+        for _ in range(args.repeat):
+            start_time = time.perf_counter()
+            data.to_netcdf(filepath, encoding=encoding)
+            timings.append(time.perf_counter() - start_time)
+
+        size = filepath.stat().st_size
+        dtype = "float64" if out_dtypes is None else "input"
+        print(
+            f"{compression:>4} level {complevel} shuffle {shuffle!s:>5} dtype {dtype:>7}:"
+            f" {min(timings):.3f} s | {size / 1e6:7.1f} MB | {data.nbytes / 1e6 / min(timings):7.1f} MB/s"
+        )
+        filepath.unlink()
+
+
+if __name__ == "__main__":
+    main()
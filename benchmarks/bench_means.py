@@ -0,0 +1,66 @@
+import time
+import argparse
+import cftime
+import numpy as np
+import xarray as xr
+
+from src.utils import smean, amean, mmean, numba
+
+
+def parse_arguments():
+    """Parses command-line arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark the weighted mean kernels.")
+
+    parser.add_argument("-y", "--years", help="Simulated years", type=int, default=10)
+    parser.add_argument("--ncol", help="Number of columns", type=int, default=21600)
+    parser.add_argument("--lev", help="Number of levels", type=int, default=72)
+    parser.add_argument("--nvars", help="Number of 3D variables", type=int, default=4)
+    parser.add_argument("-r", "--repeat", help="Repetitions per kernel", type=int, default=3)
+
+    return parser.parse_args()
+
+
+def synthetic_data(years, ncol, lev, nvars):
+    """
+    Monthly float32 data chunked one month per chunk, like open_mfdataset over h0 files.
+    """
+    time = [cftime.DatetimeNoLeap(y, m, 15) for y in range(1, years + 1) for m in range(1, 13)]
+    rng = np.random.default_rng(0)
+    data = xr.Dataset(
+        {
+            f"V{i}": (("time", "lev", "ncol"), rng.random((len(time), lev, ncol), dtype=np.float32))
+            for i in range(nvars)
+        },
+        coords={"time": time, "lev": np.arange(lev, dtype=np.float64)},
+    )
+    return data.chunk({"time": 1})
+
+
+def main():
+    args = parse_arguments()
+    data = synthetic_data(args.years, args.ncol, args.lev, args.nvars)
+    print(f"\nInput: {data.nbytes / 1e9:.2f} GB, {data.sizes['time']} months")
+
+    kernels = ["xarray", "numpy"] + (["numba"] if numba is not None else [])
+    means = {
+        "sea": lambda kernel: smean(data, kernel=kernel),
+        "ann": lambda kernel: amean(data, kernel=kernel),
+        "mon": lambda kernel: mmean(data, kernel=kernel),
+    }
+
+    for name, mean in means.items():
+        reference = None
+        for kernel in kernels:
+            timings = []
+            for _ in range(args.repeat):
+                start_time = time.perf_counter()
+                ds = mean(kernel).load()
+                timings.append(time.perf_counter() - start_time)
+
+            reference = ds if reference is None else reference
+            error = max(float(abs(ds[var] - reference[var]).max()) for var in ds.data_vars)
+            print(f"{name} {kernel:>7}: best {min(timings):.3f} s | max abs diff vs xarray {error:.2e}")
+
+
+if __name__ == "__main__":
+    main()
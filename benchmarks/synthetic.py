@@ -0,0 +1,114 @@
+import cftime
+import numpy as np
+import xarray as xr
+
+from pathlib import Path
+from src.utils import MAMXX_TRACERS, MAMXX_EXTFRC, MAMXX_MODES, MAMXX_TABLE
+
+UNITS = "days since 0001-01-01 00:00:00"
+CALENDAR = "noleap"
+
+# Packed EAMxx sources with a vertical dimension; the unpacked ones (CCN) are all 3D
+VERTICAL_SOURCES = {"mam4_external_forcing", "dgnum", "dgnumwet", "qaerwat"}
+
+
+def month_time(year, month):
+    """
+    Time stamp and bounds of a monthly mean, stamped at the end of the month like EAM h0 files.
+    """
+    start = cftime.DatetimeNoLeap(year, month, 1)
+    end = cftime.DatetimeNoLeap(year + month // 12, month % 12 + 1, 1)
+    time = cftime.date2num([end], UNITS, CALENDAR)
+    bounds = cftime.date2num([[start, end]], UNITS, CALENDAR)
+    return time, bounds
+
+
+def static_fields(ncol):
+    lat = np.linspace(-89.5, 89.5, ncol)
+    area = np.cos(np.deg2rad(lat))
+    return {
+        "area": (("ncol",), area / area.sum()),
+        "lat": (("ncol",), lat),
+        "lon": (("ncol",), np.linspace(0, 360, ncol, endpoint=False)),
+    }
+
+
+def eam_month(rng, year, month, ncol, lev, nvars):
+    time, bounds = month_time(year, month)
+    lat = np.linspace(-89.5, 89.5, ncol)
+    variables = {
+        f"V{i}": (("time", "lev", "ncol"), rng.random((1, lev, ncol), dtype=np.float32))
+        for i in range(nvars)
+    }
+    variables.update({
+        "PS": (("time", "ncol"), 1e5 + rng.random((1, ncol), dtype=np.float32)),
+        "LANDFRAC": (("time", "ncol"), (lat > 0).astype(np.float32)[None]),
+        "time_bnds": (("time", "nbnd"), bounds),
+        "date": (("time",), np.array([year * 10000 + month * 100 + 1], dtype=np.int32)),
+        **static_fields(ncol),
+    })
+    return xr.Dataset(
+        variables,
+        coords={
+            "time": ("time", time, {"units": UNITS, "calendar": CALENDAR, "bounds": "time_bnds"}),
+            "lev": ("lev", np.linspace(1, 1000, lev)),
+        },
+    )
+
+
+def eamxx_month(rng, year, month, ncol, lev, nvars, constituents):
+    """
+    EAMxx-style output with every packed variable read by prep_mamxx.
+    """
+    time, bounds = month_time(year, month)
+
+    def field(*dims):
+        sizes = {"time": 1, "ncol": ncol, "lev": lev, "swband": 14, "ext_cnt": len(MAMXX_EXTFRC),
+                 "nmodes": len(MAMXX_MODES), "num_phys_constituents": constituents,
+                 "num_gas_aerosol_constituents": 31}
+        return dims, rng.random([sizes[dim] for dim in dims], dtype=np.float32)
+
+    variables = {f"V{i}": field("time", "ncol", "lev") for i in range(nvars)}
+    for source, dim, _, _ in MAMXX_TABLE.values():
+        vertical = ["lev"] if dim is None or source in VERTICAL_SOURCES else []
+        packed = [] if dim is None else [dim]
+        variables[source] = field("time", "ncol", *vertical, *packed)
+    variables.update({
+        "aero_tau_sw": field("time", "ncol", "swband", "lev"),
+        "aero_ssa_sw": field("time", "ncol", "swband", "lev"),
+        "ps": field("time", "ncol"),
+        "landfrac": field("time", "ncol"),
+        "precip_pg2": field("time", "ncol"),
+        "time_bnds": (("time", "dim2"), bounds),
+        **static_fields(ncol),
+    })
+    return xr.Dataset(
+        variables,
+        coords={
+            "time": ("time", time, {"units": UNITS, "calendar": CALENDAR}),
+            "lev": ("lev", np.arange(lev, dtype=np.float64)),
+        },
+    )
+
+
+def write_case(outdir, case, model="eam", years=2, ncol=21600, lev=72, nvars=4, constituents=None):
+    """
+    Write monthly h0 files of a synthetic case; existing files are kept.
+    """
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    constituents = max(constituents or 0, len(MAMXX_TRACERS))
+
+    rng = np.random.default_rng(0)
+    for year in range(1, years + 1):
+        for month in range(1, 13):
+            filepath = outdir / f"{case}.{model}.h0.{year:04d}-{month:02d}.nc"
+            if filepath.exists():
+                continue
+            if model == "scream":
+                data = eamxx_month(rng, year, month, ncol, lev, nvars, constituents)
+            else:
+                data = eam_month(rng, year, month, ncol, lev, nvars)
+            data.to_netcdf(filepath)
+
+    return outdir
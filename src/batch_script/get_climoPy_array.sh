@@ -0,0 +1,13 @@
+#!/bin/bash -l
+#SBATCH --job-name=genclimo
+#SBATCH --output=<jobDir>/genclimo.o%A_%a
+#SBATCH --account=<account>
+#SBATCH --nodes=1
+#SBATCH --time=<wallMin>
+#SBATCH --qos=<partition>
+#SBATCH --constraint=cpu
+#SBATCH --array=0-<lastTask>
+
+source <source>
+# user-defined environment
+python <genclimoDir>/genclimo.py $(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" <jobDir>/genclimo_tasks.txt)
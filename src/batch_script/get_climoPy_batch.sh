@@ -1,6 +1,6 @@
 #!/bin/bash -l
 #SBATCH --job-name=genclimo
-#SBATCH --output=<outDir>/genclimo.o%j
+#SBATCH --output=<jobDir>/genclimo.o%j
 #SBATCH --account=<account>
 #SBATCH --nodes=1
 #SBATCH --time=<wallMin>
@@ -9,4 +9,4 @@
 
 source <source>
 # user-defined environment
-python <genclimoDir>/genclimo.py -c <case> -s <start> -e <end> -indir <directory> -outdir <outDir> -m <model> -v <vars> -t <time>
+python <genclimoDir>/genclimo.py -c <case> -s <start> -e <end> -indir <directory> -outdir <outDir> -m <model> -v <vars> -t <time> <options>
@@ -0,0 +1,117 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+import threading
+
+from pathlib import Path
+
+
+def replace_atomic(source, filepath):
+    """
+    Move a completely written temporary file or store to its final path.
+    """
+    if Path(filepath).is_dir():
+        shutil.rmtree(filepath)
+    os.replace(source, filepath)
+
+
+def tmp_path(filepath):
+    return Path(filepath).with_name(f".{Path(filepath).name}.{os.getpid()}.tmp")
+
+
+def fingerprint(flist, options):
+    """
+    Hash of the input files (name, size and modification time) and the run options.
+    """
+    inputs = []
+    for filepath in flist:
+        stat = Path(filepath).stat()
+        inputs.append([Path(filepath).name, stat.st_size, stat.st_mtime])
+
+    return hashlib.sha1(json.dumps([inputs, options], sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Checkpoint:
+    """
+    Manifest of a resumable run: completed outputs and the files accumulated in the checkpointed monthly sums.
+
+    The manifest is discarded when the inputs or options have changed since it was written. Temporary
+    files of the manifest, the checkpointed sums and the managed outputs left by killed runs are removed.
+    """
+
+    def __init__(self, filepath, acc_path, key, managed=()):
+        self.filepath = Path(filepath)
+        self.acc_path = Path(acc_path)
+        self.key = key
+        self.outputs = {}
+        self.acc_files = []
+        self.acc_complete = False
+        self._lock = threading.Lock()
+        self.remove_stale([self.filepath, self.acc_path] + [Path(filepath) for filepath in managed])
+
+        if not self.filepath.exists():
+            return
+
+        with open(self.filepath) as file:
+            manifest = json.load(file)
+
+        if manifest.get("fingerprint") != key:
+            print("\nInputs or options changed since the last checkpoint; starting over.")
+            return
+
+        self.outputs = manifest["outputs"]
+        if self.acc_path.exists():
+            self.acc_files = manifest["acc_files"]
+            self.acc_complete = manifest["acc_complete"]
+        print(f"\nResuming: {len(self.outputs)} output(s) and {len(self.acc_files)} accumulated file(s) done.")
+
+    def remove_stale(self, paths):
+        """
+        Remove the temporary files and stores left by killed runs next to the given outputs.
+        """
+        for path in paths:
+            for stale in path.parent.glob(f".{glob.escape(path.name)}.*.tmp"):
+                print("Removing stale temporary output:", str(stale))
+                if stale.is_dir():
+                    shutil.rmtree(stale)
+                else:
+                    stale.unlink()
+
+    def done(self, filepath):
+        """
+        Check whether the output was completed by an earlier run with the same inputs.
+        """
+        filepath = Path(filepath)
+        return filepath.name in self.outputs and filepath.exists()
+
+    def complete(self, filepath):
+        with self._lock:
+            self.outputs[Path(filepath).name] = True
+            self.save()
+
+    def accumulated(self, files, complete=False):
+        with self._lock:
+            self.acc_files, self.acc_complete = list(files), complete
+            self.save()
+
+    def finish(self):
+        """
+        Remove the checkpointed sums once every output is written.
+        """
+        if self.acc_path.exists():
+            self.acc_path.unlink()
+        self.accumulated([])
+
+    def save(self):
+        manifest = {
+            "fingerprint": self.key,
+            "outputs": self.outputs,
+            "acc_files": self.acc_files,
+            "acc_complete": self.acc_complete,
+        }
+        path = tmp_path(self.filepath)
+        with open(path, "w") as file:
+            json.dump(manifest, file, indent=2)
+        replace_atomic(path, self.filepath)
@@ -0,0 +1,143 @@
+import os
+import math
+import dask
+
+from dask.utils import format_bytes
+
+SPATIAL_DIMS = ["ncol", "lat", "lon"]
+
+# Share of the memory the chunks are planned for; dask starts spilling at the same fraction
+MEMORY_TARGET = 0.6
+
+# Copies of an input chunk held by one task: the chunk, its float64 weighted values and the partial sums
+WORKING_COPIES = {"xarray": 5, "numpy": 4, "numba": 2}
+STATS_COPIES = 4
+
+# Smaller blocks only add scheduling overhead, even when memory is short
+MIN_BLOCK = 16 * 2**20
+
+# Rates assumed by the runtime estimate of a dry run (parallel filesystem, one node)
+FILE_LATENCY = 0.1
+READ_BANDWIDTH = 1e9
+REDUCE_RATE = 2.5e8
+WRITE_BANDWIDTH = 2e8
+
+
+def node_memory():
+    """
+    Memory of this job: the Slurm allocation when set, otherwise the memory available on the node.
+    """
+    if os.environ.get("SLURM_MEM_PER_NODE"):
+        return int(os.environ["SLURM_MEM_PER_NODE"]) * 2**20
+
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def compute_resources():
+    """
+    Threads computing at once and the memory they share, from the distributed cluster if one is running.
+    """
+    try:
+        from distributed import default_client
+
+        workers = default_client().scheduler_info()["workers"].values()
+        threads = sum(worker["nthreads"] for worker in workers)
+        memory = sum(worker["memory_limit"] or node_memory() / len(workers) for worker in workers)
+        return threads, memory
+    except (ImportError, ValueError):
+        threads = dask.config.get("num_workers", None) or os.cpu_count()
+        return threads, node_memory()
+
+
+def plan_chunks(sizes, var_dims, itemsize, nperiods, kernel="xarray", nstats=0, steps_per_year=12, ncases=1):
+    """
+    Input chunks for the climo reduction that keep the working set of every thread within memory.
+
+    Chunks hold a year along time and split the spatial dimension; fused kernels reduce the whole
+    time axis at once, so their blocks are sized for it. Cases reduced at once share the threads
+    and memory. Returns the chunks, the bytes of a block and the expected peak memory, with the
+    resources they were planned for.
+    """
+    threads, memory = compute_resources()
+    threads, memory = max(threads // ncases, 1), memory // ncases
+    spatial = next((dim for dim in SPATIAL_DIMS if dim in sizes), None)
+    ncol = math.prod(sizes[dim] for dim in SPATIAL_DIMS if dim in sizes)
+
+    # Values per time step and spatial column of the widest variable, and of all of them
+    extents = [
+        math.prod(sizes[dim] for dim in dims if dim != "time" and dim not in SPATIAL_DIMS)
+        for dims in var_dims.values()
+        if "time" in dims
+    ] or [1]
+    widest, total = max(extents), sum(extents)
+
+    # Monthly sums, statistics states (per month, per annual and seasonal period, and of the year being
+    # read) and climos of every variable stay in memory until written
+    states = (12 * (5 + 2) + 5 * 6) * bool(nstats)
+    results = total * ncol * 8 * (12 + states + nperiods * (1 + nstats))
+
+    ntime = steps_per_year if kernel == "xarray" else sizes.get("time", steps_per_year)
+    copies = WORKING_COPIES.get(kernel, WORKING_COPIES["xarray"]) + STATS_COPIES * bool(nstats)
+    budget = max(memory * MEMORY_TARGET - results, 0) / threads / copies
+
+    # Rows of the spatial dimension per chunk: what fits the budget, split further so that every thread has a block
+    nrows = sizes[spatial] if spatial is not None else 1
+    row = ntime * widest * itemsize * (ncol // nrows)
+    min_rows = math.ceil(MIN_BLOCK / row)
+    rows = max(int(budget // row), min_rows)
+    if kernel != "xarray":
+        rows = min(rows, max(math.ceil(nrows / threads), min_rows))
+    rows = min(rows, nrows)
+
+    chunks = {"time": steps_per_year}
+    chunks.update({dim: -1 for dim in sizes if dim != "time"})
+    if spatial is not None:
+        chunks[spatial] = rows
+
+    block = row * rows
+    return {
+        "chunks": chunks,
+        "block_bytes": block,
+        "peak_bytes": block * copies * threads + results,
+        "results_bytes": results,
+        "memory_bytes": memory,
+        "threads": threads,
+    }
+
+
+def describe_plan(plan):
+    """
+    One-line summary of a chunk plan.
+    """
+    chunks = ", ".join(f"{dim}={size}" for dim, size in plan["chunks"].items())
+    return (
+        f"{chunks}; {format_bytes(plan['block_bytes'])} blocks on {plan['threads']} threads, "
+        f"expected peak {format_bytes(plan['peak_bytes'])} of {format_bytes(plan['memory_bytes'])}"
+    )
+
+
+def estimate_runtime(nfiles, bytes_read, bytes_written, threads, backend="dask", prefetch=False, nstats=0):
+    """
+    Seconds to read, reduce and write a run from its input and output bytes.
+
+    The dask backend opens and reduces the files on every thread; the streaming backend reads one
+    file at a time, overlapping the next reads with the reduction when prefetching.
+    """
+    passes = 1 + bool(nstats)
+    if backend == "streaming":
+        read = nfiles * FILE_LATENCY + bytes_read / READ_BANDWIDTH
+        reduce = bytes_read * passes / REDUCE_RATE
+    else:
+        read = nfiles * FILE_LATENCY / threads + bytes_read / READ_BANDWIDTH
+        reduce = bytes_read * passes / (REDUCE_RATE * threads)
+    write = bytes_written / WRITE_BANDWIDTH
+
+    total = (max(read, reduce) if prefetch else read + reduce) + write
+    return {"read_s": read, "reduce_s": reduce, "write_s": write, "total_s": total}
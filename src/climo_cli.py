@@ -1,51 +1,173 @@
+import sys
 import time
+import dask
 import argparse
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from src.get_climoFiles import GetClimo
+from src.utils import start_scheduler, expand_cases, case_path, COMPRESSIONS, DTYPES
 
 
 def parse_arguments():
     """Parses command-line arguments."""
     parser = argparse.ArgumentParser(description="Process climate data.")
 
-    parser.add_argument("-c", "--case", help="Case name", required=True)
+    parser.add_argument("-c", "--case", help="Case name, or comma separated case names and wildcard patterns (ex: 'ens*') processed in one run", required=True)
     parser.add_argument("-s", "--start", help="Start year", required=True)
     parser.add_argument("-e", "--end", help="End year", default=None)
-    parser.add_argument("-indir", "--input_dir", help="Input directory", default=None)
-    parser.add_argument("-outdir", "--output_dir", help="Climo output directory", default=None)
+    parser.add_argument("-indir", "--input_dir", help="Input directory ({case} is replaced by each case name)", default=None)
+    parser.add_argument("-outdir", "--output_dir", help="Climo output directory ({case} is replaced by each case name)", default=None)
     parser.add_argument("-m", "--model", help="Model name (eam or cam)", default="eam")
     parser.add_argument("-v", "--variable", help="Variable names", default=None)
-    parser.add_argument("-t", "--time_freq", help="Time frequency (sea=seasonal | mon=monthly)", default=None)
+    parser.add_argument("-t", "--time_freq", help="Time frequency (ann=annual | sea=seasonal | mon=monthly | all=annual, seasonal and monthly)", default=None)
+    parser.add_argument("--stream", help="History stream of the input files (h0=monthly | h1, h2, ...=daily or sub-daily, averaged to monthly means file by file)", default="h0")
+    parser.add_argument("-b", "--backend", help="Reduction backend (dask | streaming=file by file, constant memory)", default="dask")
+    parser.add_argument("-k", "--kernel", help="Weighted mean kernel (xarray | numpy | numba)", default="xarray")
+    parser.add_argument("--incremental", help="Update the climos of an earlier run from its accumulator, reading only the new years", action="store_true")
+    parser.add_argument("--stats", help="Comma separated statistics of the monthly or yearly means written as <var>_<stat> (std | var | min | max | count)", default=None)
+    parser.add_argument("--regions", help="Comma separated regions of the area-weighted means written to <case>_..._regional_climo.nc (global | land | ocean | nh | sh | tropics | nh_extratropics | sh_extratropics | arctic | antarctic | <surface>_<band> | <south>:<north>)", default=None)
+    parser.add_argument("--concurrent-cases", help="Number of cases reduced at once on the shared dask workers", type=int, default=2)
+    parser.add_argument("--scheduler", help="Dask scheduler (threads | processes | distributed | synchronous)", default="threads")
+    parser.add_argument("--workers", help="Number of dask workers (processes or threads)", type=int, default=None)
+    parser.add_argument("--threads-per-worker", help="Threads per worker of the distributed cluster", type=int, default=None)
+    parser.add_argument("--memory-limit", help="Memory limit per worker of the distributed cluster (ex: 4GB)", default=None)
+    parser.add_argument("--group", help="Variable group processed by this job-array task (0-based)", type=int, default=0)
+    parser.add_argument("--ngroups", help="Number of variable groups of the job array", type=int, default=1)
+    parser.add_argument("--acc-only", help="Only write the accumulator of this task (used by the job-array tasks)", action="store_true")
+    parser.add_argument("--merge", help="Write the climos from the job-array task accumulators in --groups-dir (default: <outdir>/genclimo_groups)", action="store_true")
+    parser.add_argument("--groups-dir", help="Directory of the job-array task accumulators read by --merge ({case} is replaced by each case name)", default=None)
+    parser.add_argument("--no-index", help="Do not use or update the file index (.genclimo_index.json) of the input directory", action="store_true")
+    parser.add_argument("--output-format", help="Climo output (nc=one NetCDF file per period | zarr=one Zarr store with a period dimension)", default="nc")
+    parser.add_argument("--compression", help="Compression of the climo files", choices=COMPRESSIONS, default="zlib")
+    parser.add_argument("--complevel", help="Compression level (1-9)", type=int, default=1)
+    parser.add_argument("--no-shuffle", help="Disable the HDF5 shuffle filter (zlib only: zstd is written without it)", action="store_true")
+    parser.add_argument("--dtype", help="Data type of the climos (input=same as the input files | float64)", choices=DTYPES, default="input")
+    parser.add_argument("--resume", help="Checkpoint the run and resume the checkpoint of an earlier run with the same inputs and options", action="store_true")
+    parser.add_argument("--checkpoint-interval", help="Seconds between checkpoints of the streamed monthly sums", type=float, default=60)
+    parser.add_argument("--prefetch", help="Number of input files read ahead in background threads while the current one is reduced (streaming backend, 0=off)", type=int, default=0)
+    parser.add_argument("--prefetch-workers", help="Threads reading the prefetched files", type=int, default=2)
+    parser.add_argument("--scratch", help="Copy the prefetched files to this local directory instead of reading them into the page cache", default=None)
+    parser.add_argument("--plan", help="Dry run: print the files, years, variables and outputs with the estimated bytes, peak memory and runtime, and write them to <outdir>/<case>_..._genclimo_plan.json (reads file metadata only)", action="store_true")
+    parser.add_argument("--report", help="Write per-stage wall time, peak memory and IO to <outdir>/<case>_..._genclimo_report.json", action="store_true")
+    parser.add_argument("--dask-profile", help="Add dask task counts and compute time per task type to the report", action="store_true")
 
     return parser.parse_args()
 
 
-def main():
-    """Main function to process climate data."""
-    args = parse_arguments()
-
-    output_dir = args.output_dir if args.output_dir is not None else args.input_dir
+def run_case(case, args, ncases=1, keep_going=False):
+    """Makes the climos of one case; returns its summary."""
+    input_dir = case_path(args.input_dir, case)
+    output_dir = case_path(args.output_dir, case) if args.output_dir is not None else input_dir
 
     start_time = time.perf_counter()
 
     climo_instance = GetClimo(
-        case=args.case,
+        case=case,
         start=args.start,
-        path=args.input_dir,
+        path=input_dir,
         outpath=output_dir,
         end=args.end,
         ts=args.time_freq,
         mod=args.model,
+        stream=args.stream,
+        backend=args.backend,
+        kernel=args.kernel,
+        incremental=args.incremental,
+        stats=[x.strip() for x in args.stats.split(",")] if args.stats else None,
+        regions=[x.strip() for x in args.regions.split(",")] if args.regions else None,
+        parallel=args.scheduler != "threads" or args.workers is not None,
+        group=args.group,
+        ngroups=args.ngroups,
+        acc_only=args.acc_only,
+        merge=args.merge,
+        groups_dir=case_path(args.groups_dir, case),
+        output_format=args.output_format,
+        index=not args.no_index,
+        compression=args.compression,
+        complevel=args.complevel,
+        shuffle=not args.no_shuffle,
+        dtype=args.dtype,
+        resume=args.resume,
+        checkpoint_interval=args.checkpoint_interval,
+        prefetch=args.prefetch,
+        prefetch_workers=args.prefetch_workers,
+        scratch=args.scratch,
+        ncases=ncases,
+        report=args.report,
+        dask_profile=args.dask_profile,
     )
 
     if args.variable is not None:
         climo_instance.variable = args.variable
 
-    climo_instance.get_nc()
+    summary = {"case": case, "status": "done", "files": 0, "outputs": 0}
+    try:
+        if args.plan:
+            summary["outputs"] = len(climo_instance.write_plan()["outputs"])
+        else:
+            climo_instance.get_nc()
+            summary["outputs"] = len(climo_instance.outputs())
+    except Exception:
+        # One failed case does not stop the others
+        if not keep_going:
+            raise
+        print(f"\nCase {case} failed:\n{traceback.format_exc()}")
+        summary["status"] = "failed"
+    summary["files"] = climo_instance.nfiles
+    summary["wall_s"] = time.perf_counter() - start_time
+    return summary
+
+
+def print_summary(summaries):
+    """Prints one line per case."""
+    width = max(len(summary["case"]) for summary in summaries)
+    print("\nCase summary:")
+    print(f"  {'case':<{width}}  status  files  outputs  time (s)")
+    for summary in summaries:
+        print(
+            f"  {summary['case']:<{width}}  {summary['status']:<6}  {summary['files']:>5}  "
+            f"{summary['outputs']:>7}  {summary['wall_s']:>8.1f}"
+        )
+
+
+def main():
+    """Main function to process climate data."""
+    args = parse_arguments()
+
+    cases = expand_cases(args.case, args.input_dir, args.model, args.stream)
+    ncases = max(min(args.concurrent_cases, len(cases)), 1)
+    if len(cases) > 1:
+        print(f"\nProcessing {len(cases)} cases, {ncases} at a time:", ", ".join(cases))
+
+    start_time = time.perf_counter()
+
+    if args.plan:
+        # A dry run only reads metadata: the workers are counted, not started
+        client = None
+        dask.config.set(num_workers=args.workers * (args.threads_per_worker or 1) if args.workers else None)
+    else:
+        client = start_scheduler(args.scheduler, args.workers, args.threads_per_worker, args.memory_limit, shared=ncases > 1)
+
+    try:
+        if len(cases) == 1:
+            summaries = [run_case(cases[0], args)]
+        else:
+            # Cases run in their own threads; their reads and reductions interleave on the dask workers
+            with ThreadPoolExecutor(max_workers=ncases) as pool:
+                summaries = list(pool.map(lambda case: run_case(case, args, ncases, keep_going=True), cases))
+    finally:
+        if client is not None:
+            client.shutdown()
+
+    if len(cases) > 1:
+        print_summary(summaries)
 
     end_time = time.perf_counter()
     print(f"\nFinished in {round(end_time - start_time, 2)} second(s)")
 
+    if any(summary["status"] == "failed" for summary in summaries):
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,133 @@
+import os
+import json
+import threading
+import cftime
+import numpy as np
+import xarray as xr
+
+from pathlib import Path
+from src.utils import get_years
+
+INDEX_NAME = ".genclimo_index.json"
+
+# Cases processed in one run index their files from several threads
+INDEX_LOCK = threading.Lock()
+
+
+def index_entry(filepath):
+    """
+    Metadata of an input file, read without loading any data.
+    """
+    stat = filepath.stat()
+    with xr.open_dataset(filepath, decode_times=False) as data:
+        time = data["time"]
+        bounds = time.attrs.get("bounds", "time_bnds")
+        return {
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "units": time.attrs.get("units"),
+            "calendar": time.attrs.get("calendar", "standard"),
+            "time": time.values.tolist(),
+            "bounds": data[bounds].values.tolist() if bounds in data else None,
+            "variables": {var: list(data[var].dims) for var in data.data_vars},
+            "dims": dict(data.sizes),
+        }
+
+
+def write_index(index, dirs):
+    """
+    Write the index to the first writable directory; returns the path written.
+
+    Entries written meanwhile by the other cases of this run are kept.
+    """
+    with INDEX_LOCK:
+        for directory in dirs:
+            filepath = Path(directory) / INDEX_NAME
+            tmp_path = filepath.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            try:
+                if filepath.exists():
+                    with open(filepath) as file:
+                        index = {**json.load(file), **index}
+                with open(tmp_path, "w") as file:
+                    json.dump(index, file)
+                # Concurrent runs never see a partially written index
+                os.replace(tmp_path, filepath)
+                return filepath
+            except (OSError, ValueError):
+                continue
+
+    return None
+
+
+def file_index(flist, path, outpath=None):
+    """
+    Metadata of the given files from the index cached in the input (or output) directory.
+
+    Files that are new or modified since they were indexed are read and the index is updated.
+    """
+    dirs = [Path(path)] + ([Path(outpath)] if outpath is not None else [])
+
+    index = {}
+    for directory in reversed(dirs):
+        if (Path(directory) / INDEX_NAME).exists():
+            with open(Path(directory) / INDEX_NAME) as file:
+                index.update(json.load(file))
+
+    updated = 0
+    for filepath in flist:
+        key = str(Path(filepath).absolute())
+        stat = filepath.stat()
+        entry = index.get(key)
+        if entry is None or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+            index[key] = index_entry(filepath)
+            updated += 1
+
+    if updated:
+        print(f"\nIndexed {updated} file(s):", str(write_index(index, dirs)))
+
+    return {filepath: index[str(Path(filepath).absolute())] for filepath in flist}
+
+
+def entry_dates(entry, values):
+    return cftime.num2date(values, entry["units"], entry["calendar"])
+
+
+def entry_years(filepath, entry):
+    """
+    Simulated years of a file: from the middle of its time bounds, the file name or its time stamps.
+    """
+    if entry["bounds"] is not None:
+        return {date.year for date in entry_dates(entry, np.mean(entry["bounds"], axis=-1))}
+
+    years = get_years([filepath])
+    if len(years) > 0:
+        return set(years.tolist())
+
+    return {date.year for date in entry_dates(entry, entry["time"])}
+
+
+def index_select(index, start=None, end=None):
+    """
+    Files with data inside [start, end], in time order.
+    """
+    flist = [
+        filepath
+        for filepath, entry in index.items()
+        if (start is None or max(entry_years(filepath, entry)) >= int(start))
+        and (end is None or min(entry_years(filepath, entry)) <= int(end))
+    ]
+    return sorted(flist, key=lambda filepath: entry_dates(index[filepath], index[filepath]["time"][0]))
+
+
+def index_shift(index):
+    """
+    Check whether the time stamps mark the end of each month and need correcting.
+    """
+    entries = list(index.values())
+    if all(entry["bounds"] is not None for entry in entries):
+        return all(np.allclose(entry["time"], np.array(entry["bounds"])[:, -1]) for entry in entries)
+
+    # Without bounds: the time stamps span more years than the file names
+    actual_years = get_years(list(index))
+    dummy_years = {date.year for entry in entries for date in entry_dates(entry, entry["time"])}
+    return len(actual_years) < len(dummy_years)
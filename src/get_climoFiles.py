@@ -1,14 +1,41 @@
-import re
 import xarray as xr
 import numpy as np
-import multiprocessing as mp
+import re
+import json
+import time
 import warnings
+import threading
 
 from pathlib import Path
-from src.utils import shift_time, smean, amean, mmean, get_dir_path, prep_mamxx
+from dask.utils import format_bytes
+from contextlib import nullcontext
+from src.profiling import StageProfiler
+from src.file_index import file_index, index_select, index_shift, entry_dates
+from src.chunking import plan_chunks, describe_plan, estimate_runtime, WORKING_COPIES, STATS_COPIES
+from src.prefetch import Prefetcher
+from src.regions import region_weights, regional_means, parse_region, LANDFRAC_NAMES
+from src.checkpoint import Checkpoint, fingerprint, replace_atomic, tmp_path
+from src.utils import (
+    shift_time, smean, amean, mmean, month_sums, smean_from_mmean, amean_from_mmean, attach_lev,
+    get_dir_path, get_years, prep_mamxx, mamxx_name, mamxx_sources, retain_attr, nc_encoding,
+    is_zarr, open_input, stamped_at_end, time_bounds, month_pieces, month_stats, acc_variables, combine_sums, stats_from_sums,
+    year_stats, open_sums, close_year,
+    ENCODED_TIMES, STATISTICS, COMPRESSIONS, DTYPES,
+)
 
 warnings.simplefilter(action="ignore", category=FutureWarning)
 
+NC_WRITE_LOCK = threading.Lock()
+
+# Writers of the climos, each taking the dataset of all periods
+SINKS = {"nc": "write_nc", "zarr": "write_zarr", "regional": "write_regional"}
+
+# Options that change the outputs of a run: a checkpoint is only resumed when they are unchanged
+CHECKPOINT_OPTIONS = [
+    "start", "end", "ts", "_var", "mod", "stream", "backend", "kernel", "group", "ngroups", "acc_only", "merge",
+    "incremental", "stats", "compression", "complevel", "shuffle", "dtype", "output_format", "regions",
+]
+
 
 class GetClimo:
     def __init__(self, case, **kwargs):
@@ -24,6 +51,45 @@ class GetClimo:
         self.tags = kwargs.get("tags", ["ANN"])
         self.numTags = kwargs.get("numTags", ["01-12"])
         self.static_vars = kwargs.get("static_vars", None)
+        self.stream = kwargs.get("stream", "h0")
+        # Sub-monthly streams are always reduced to monthly means file by file
+        self.backend = "streaming" if self.stream != "h0" else kwargs.get("backend", "dask")
+        self.kernel = kwargs.get("kernel", "xarray")
+        self.incremental = kwargs.get("incremental", False)
+        self.parallel = kwargs.get("parallel", False)
+        self.group = kwargs.get("group", 0)
+        self.ngroups = kwargs.get("ngroups", 1)
+        self.acc_only = kwargs.get("acc_only", False)
+        self.merge = kwargs.get("merge", False)
+        self.groups_dir = kwargs.get("groups_dir", None)
+        self.stats = kwargs.get("stats", None)
+        self.regions = kwargs.get("regions", None)
+        self.sinks = kwargs.get("sinks", None)
+        self.compression = kwargs.get("compression", "zlib")
+        self.complevel = kwargs.get("complevel", 1)
+        self.shuffle = kwargs.get("shuffle", True)
+        self.dtype = kwargs.get("dtype", "input")
+        self.output_format = kwargs.get("output_format", "nc")
+        self.use_index = kwargs.get("index", True)
+        self.resume = kwargs.get("resume", False)
+        self.checkpoint_interval = kwargs.get("checkpoint_interval", 60)
+        self.prefetch = kwargs.get("prefetch", 0)
+        self.prefetch_workers = kwargs.get("prefetch_workers", 2)
+        self.scratch = kwargs.get("scratch", None)
+        self.ncases = kwargs.get("ncases", 1)
+        self.prefetcher = None
+        self.checkpoint = None
+        self.index = None
+        self.dtypes = None
+        self.dask_profile = kwargs.get("dask_profile", False)
+        self.report = kwargs.get("report", False) or self.dask_profile
+        self.profiler = StageProfiler(shared=self.ncases > 1)
+        self.acc = None
+        self.stat_sums = None
+        self.last_month = None
+        self.open_year = None
+        self.chunk_plan = None
+        self.nfiles = 0
 
     @property
     def variable(self):
@@ -35,43 +101,84 @@ class GetClimo:
         vars_list = [x.strip() for x in val.split(",")]
         self._var.extend(vars_list)
 
-    def make_climo(self):
+    def get_files(self, start=None):
         self.path = get_dir_path(self.path)
         print("\nConsidering files in:", str(self.path))
 
-        fname = f"{self.case}.{self.mod}.h0.*.nc"
+        fname = f"{self.case}.{self.mod}.{self.stream}.*.nc"
         print(fname)
 
-        flist = sorted(list(Path(self.path).glob(fname)))
+        with self.profiler.stage("glob"):
+            if is_zarr(self.path):
+                flist = [Path(self.path)]
+            else:
+                flist = sorted(list(Path(self.path).glob(fname)))
+            if not flist:
+                flist = sorted(Path(self.path).glob(f"{self.case}.{self.mod}.{self.stream}.*.zarr"))
+
+        if self.use_index and flist and not is_zarr(flist[0]):
+            with self.profiler.stage("index"):
+                outpath = get_dir_path(self.outpath) if self.outpath is not None else None
+                index = file_index(flist, self.path, outpath)
+                flist = index_select(index, start, self.end)
+                self.index = {filename: index[filename] for filename in flist}
+        else:
+            if start is not None:
+                flist = [f for f in flist if all(year >= int(start) for year in get_years([f]))]
+            if self.end is not None:
+                flist = [f for f in flist if all(year <= int(self.end) for year in get_years([f]))]
+            self.index = None
         print("Considering files:\n", flist)
+        self.nfiles = len(flist)
 
-        data = xr.open_mfdataset(flist, combine="by_coords")
-        
-        if self.mod == 'scream':
-            data = prep_mamxx(data)
+        return flist
 
-        # Extract the simulated years from filenames
-        years = []
-        for filename in flist:
-            filename = str(filename).split("/")[-1]
-            match = re.search(r"h?\.(\d{4}).*\.nc$", filename)
-            if match:
-                years.append(int(match.group(1)))
+    def partition_vars(self, filename):
+        """
+        Keep every ngroups-th variable for this job-array task.
+        """
+        if self.ngroups == 1:
+            return
 
-        actual_years = np.sort(list(set(years)))
-        dummy_years = np.sort(np.unique(data["time.year"].values))
+        if self._var is None:
+            with open_input(filename) as data:
+                if self.mod == 'scream':
+                    data = prep_mamxx(data)
+                self._var = [
+                    var
+                    for var in data.variables
+                    if "time" in data[var].dims and data[var].dtype in [np.float32, np.float64]
+                ]
 
-        print("\nYears read:", dummy_years)
-        print("Actual years:", actual_years)
+        self._var = self._var[self.group::self.ngroups]
+        print(f"\nVariable group {self.group + 1} of {self.ngroups}:", self._var)
 
-        # Correct the time dimension if needed
-        if len(actual_years) < len(dummy_years):
-            print("\nCorrecting the time dimension.")
-            corrected_time = shift_time(data.time.values)
-            data = data.assign_coords(time=corrected_time)
+    def unused_vars(self, filename):
+        """
+        Time-varying variables in the input files that are not needed for the requested variables.
+        """
+        if self._var is None:
+            return []
+
+        keep = set(self._var) | {"time_bnds", "time_bounds"}
+        if self.mod == 'scream':
+            keep |= mamxx_sources(self._var)
 
-        data = data.sel(time=slice(str(self.start), str(self.end)))
+        if self.index is not None:
+            variables = self.index[filename]["variables"]
+        else:
+            with open_input(filename, decode_times=False) as data:
+                variables = {var: data[var].dims for var in data.data_vars}
 
+        return [
+            var
+            for var, dims in variables.items()
+            if "time" in dims
+            and var not in keep
+            and not (self.mod == 'scream' and mamxx_name(var) in keep)
+        ]
+
+    def select_vars(self, data):
         # Keeping the static vars
         self.static_vars = {
             var: data[var]
@@ -84,71 +191,980 @@ class GetClimo:
             self._var = []
             var_list = list(data.variables.keys())
 
+            # Time bounds read with ENCODED_TIMES are numeric but are not climo variables
+            bounds = time_bounds(data)
             for var in var_list:
-                if "time" in data[var].dims and data[var].dtype in [np.float32, np.float64]:
+                if bounds is not None and var == bounds.name:
+                    print("Removing", var)
+                elif "time" in data[var].dims and data[var].dtype in [np.float32, np.float64]:
                     self._var.append(var)
                 else:
                     print("Removing", var)
         else:
             print("\nSelected variables: ", self._var)
 
+        self.dtypes = {var: data[var].dtype for var in self._var}
+
         return data[self._var]
 
-    def to_nc(self, ind, tag, num_tag, data, ts):
-        self.outpath = get_dir_path(self.outpath)
+    def make_climo(self, start=None):
+        start = self.start if start is None else start
+        flist = self.get_files(start)
+        self.partition_vars(flist[0])
+
+        # With an index the time correction is known before opening: the time axis is then read encoded
+        shift = index_shift(self.index) if self.index is not None else None
+
+        with self.profiler.stage("open"):
+            drop = self.unused_vars(flist[0])
+            print("\nSkipping", len(drop), "unused variables.")
+
+            self.chunk_plan = self.plan(flist, drop)
+            chunks = {dim: size for dim, size in self.chunk_plan["chunks"].items() if dim != "time"}
+
+            # Only time-varying variables are concatenated; static fields are taken from the first file.
+            # Indexed files are already in time order and are concatenated without comparing coordinates.
+            combine = {"combine": "by_coords"} if self.index is None else {"combine": "nested", "concat_dim": "time"}
+            data = xr.open_mfdataset(
+                flist,
+                **combine,
+                data_vars="minimal",
+                coords="minimal",
+                compat="override",
+                drop_variables=drop,
+                decode_times=ENCODED_TIMES if shift else True,
+                chunks=chunks,
+                parallel=self.parallel,
+                engine="zarr" if is_zarr(flist[0]) else None,
+            )
+        
+        if self.mod == 'scream':
+            with self.profiler.stage("prep_mamxx"):
+                data = prep_mamxx(data, self._var, chunks)
+
+        # Extract the simulated years from filenames
+        actual_years = get_years(flist)
+        if shift is None:
+            dummy_years = np.sort(np.unique(data["time.year"].values))
+            print("\nYears read:", dummy_years)
+
+            # Correct the time dimension if needed; Zarr stores have no years in their names
+            shift = stamped_at_end(data) if is_zarr(flist[0]) else len(actual_years) < len(dummy_years)
+
+        print("\nActual years:", actual_years)
+
+        if shift:
+            print("\nCorrecting the time dimension.")
+            with self.profiler.stage("shift_time"):
+                corrected_time = shift_time(data.time, time_bounds(data))
+                data = data.assign_coords(time=corrected_time)
+
+        data = data.sel(time=slice(str(start), str(self.end)))
+        data = data.chunk({dim: size for dim, size in self.chunk_plan["chunks"].items() if dim in data.dims})
+
+        return self.select_vars(data)
+
+    def plan(self, flist, drop):
+        """
+        Chunk plan of the dask backend from the dimensions and data types of the variables read.
+        """
+        with open_input(flist[0], decode_times=False, drop_variables=drop) as data:
+            var_dims = {var: data[var].dims for var in data.data_vars}
+            itemsize = max([data[var].dtype.itemsize for var in data.data_vars if "time" in data[var].dims] or [4])
+            sizes = dict(data.sizes)
+
+        # Every input file holds as many time steps as the first one
+        sizes["time"] = (
+            sum(len(self.index[filename]["time"]) for filename in flist)
+            if self.index is not None
+            else sizes["time"] * len(flist)
+        )
+
+        plan = plan_chunks(sizes, var_dims, itemsize, self.prs, self.kernel, len(self.stats or []), ncases=self.ncases)
+        print("\nChunk plan:", describe_plan(plan))
+        if plan["peak_bytes"] > plan["memory_bytes"]:
+            print("Expected peak memory exceeds the memory available: select fewer variables or use the streaming backend.")
+        return plan
+
+    def block_bytes(self):
+        """
+        Bytes of the blocks the fused kernels gather the whole time axis into, from the chunk plan.
+        """
+        if self.kernel == "xarray" or self.chunk_plan is None:
+            return None
+        return self.chunk_plan["block_bytes"]
+
+    def dry_run(self):
+        """
+        Plan of the run from the file metadata only: files, years, variables and outputs, with the
+        estimated bytes read and written, peak memory and runtime.
+        """
+        self.set_periods()
+        flist = self.get_files(self.start)
+        self.partition_vars(flist[0])
+        drop = self.unused_vars(flist[0])
+
+        # Years of the time stamps, from the index or the time axis of each file
+        actual_years = get_years(flist)
+        if self.index is not None:
+            years = {date.year for entry in self.index.values() for date in entry_dates(entry, entry["time"])}
+            shift = index_shift(self.index)
+        else:
+            years = set()
+            for filename in flist:
+                with open_input(filename, drop_variables=drop) as data:
+                    years |= set(data["time.year"].values.tolist())
+                    shift = stamped_at_end(data) if is_zarr(filename) else None
+            if shift is None:
+                shift = len(actual_years) < len(years)
+
+        # Variables as the run selects them, on a lazily opened file
+        with open_input(flist[0], drop_variables=drop, decode_times=False, chunks={}) as data:
+            steps = data.sizes["time"]
+            read_step = sum(data[var].nbytes for var in data.data_vars if "time" in data[var].dims) / steps
+            if self.mod == 'scream':
+                data = prep_mamxx(data, self._var)
+            data = self.select_vars(data)
+            itemsize = {var: 8 if self.dtype == "float64" else data[var].dtype.itemsize for var in self._var}
+            period_bytes = sum(data[var].size // steps * itemsize[var] for var in self._var)
+
+        ntime = sum(len(self.index[filename]["time"]) for filename in flist) if self.index is not None else steps * len(flist)
+        nstats = len(self.stats or [])
+        bytes_read = int(read_step * ntime)
+        bytes_written = int(period_bytes * self.prs * (1 + nstats))
+
+        chunk_plan = self.plan(flist, drop)
+        peak = chunk_plan["peak_bytes"]
+        if self.backend == "streaming":
+            # One file at a time, converted to float64 for the sums
+            copies = WORKING_COPIES.get(self.kernel, WORKING_COPIES["xarray"]) + STATS_COPIES * bool(nstats)
+            peak = chunk_plan["results_bytes"] + int(read_step * steps * 8 / min(itemsize.values() or [8]) * copies)
+
+        runtime = estimate_runtime(
+            len(flist), bytes_read, bytes_written, chunk_plan["threads"], self.backend, bool(self.prefetch), nstats
+        )
+
+        plan = {
+            "case": self.case,
+            "start": self.start,
+            "end": self.end,
+            "ts": self.ts,
+            "backend": self.backend,
+            "kernel": self.kernel,
+            "files": [str(filename) for filename in flist],
+            "actual_years": [int(year) for year in actual_years],
+            "detected_years": sorted(int(year) for year in years),
+            "time_shift": bool(shift),
+            "variables": list(self._var),
+            "outputs": [str(filepath) for filepath in self.outputs()],
+            "bytes_read": bytes_read,
+            "bytes_written": bytes_written,
+            "chunk_plan": chunk_plan,
+            "peak_memory_bytes": peak,
+            "memory_bytes": chunk_plan["memory_bytes"],
+            "threads": chunk_plan["threads"],
+            "runtime": runtime,
+        }
+
+        print(f"\nPlan for {self.case}:")
+        print(f"  {len(flist)} files, actual years {plan['actual_years']}, detected years {plan['detected_years']}"
+              + (" (time axis corrected)" if shift else ""))
+        print(f"  {len(self._var)} variables, {len(plan['outputs'])} outputs")
+        print(f"  {format_bytes(bytes_read)} read, {format_bytes(bytes_written)} written before compression")
+        print(f"  Expected peak memory {format_bytes(peak)} of {format_bytes(plan['memory_bytes'])}")
+        print(
+            f"  Estimated runtime {runtime['total_s'] / 60:.1f} min (read {runtime['read_s']:.0f} s, "
+            f"reduce {runtime['reduce_s']:.0f} s, write {runtime['write_s']:.0f} s on {plan['threads']} threads)"
+        )
+        return plan
+
+    def plan_path(self):
+        group = f"_group{self.group}" if self.ngroups > 1 else ""
+        return get_dir_path(self.outpath) / f"{self.case}_{self.start}01_{self.end}12{group}_genclimo_plan.json"
+
+    def write_plan(self):
+        plan = self.dry_run()
+        filepath = self.plan_path()
+        print("\nSaving plan:\n", str(filepath))
+        with open(filepath, "w") as file:
+            json.dump(plan, file, indent=2, default=str)
+        return plan
+
+    def stream_climo(self, start=None):
+        """
+        Accumulate days-weighted monthly sums file by file, keeping one file in memory at a time.
+        """
+        start = self.start if start is None else start
+        flist = self.get_files(start)
+        self.partition_vars(flist[0])
+
+        # Only the last file can carry a time stamp past the last simulated year
+        actual_years = get_years(flist)
+        drop = self.unused_vars(flist[0])
+        print("\nSkipping", len(drop), "unused variables.")
+
+        if self.index is not None:
+            shift = index_shift(self.index)
+        else:
+            with open_input(flist[-1], drop_variables=drop) as data:
+                last_year = data["time.year"].values.max()
+                if is_zarr(flist[-1]):
+                    shift = stamped_at_end(data)
+                else:
+                    shift = len(actual_years) > 0 and last_year > actual_years[-1]
+
+            print("\nLast year read:", last_year)
+        print("Actual years:", actual_years)
+
+        if shift:
+            print("\nCorrecting the time dimension.")
+
+        sums, mdays, template = None, None, None
+        done = []
+        if self.checkpoint is not None and self.checkpoint.acc_files:
+            print("\nResuming from the checkpointed monthly sums.")
+            acc = xr.load_dataset(self.checkpoint.acc_path)
+            self.last_month = acc.attrs.get("last_month")
+            self.open_year = acc.attrs.get("open_year")
+            sums, mdays, template = self.split_acc(acc)
+            done = list(self.checkpoint.acc_files)
+
+        # Sums, valid samples, first time and pieces of the months not complete yet (sub-monthly streams)
+        months = {}
+        last_checkpoint = time.perf_counter()
+        todo = [filename for filename in flist if str(filename) not in done]
+        for name, data in self.stream_inputs(todo, drop, ENCODED_TIMES if shift else True):
+            if name in done:
+                continue
+
+            with self.profiler.stage("stream"):
+                if self.mod == 'scream':
+                    data = prep_mamxx(data, self._var)
+
+                if shift:
+                    data = data.assign_coords(time=shift_time(data.time, time_bounds(data)))
+
+                data = data.sel(time=slice(str(start), str(self.end)))
+                if self.last_month is not None:
+                    # Pieces read again after a resume can hold months that are already accumulated
+                    data = data.isel(time=data["time.year"] * 100 + data["time.month"] > self.last_month)
+                if data.sizes["time"] == 0:
+                    continue
+
+                if template is None:
+                    template = self.select_vars(data).isel(time=[]).load()
+                    self.static_vars = {var: val.load() for var, val in self.static_vars.items()}
+
+                names = [name]
+                if self.stream != "h0":
+                    data, names = self.complete_months(months, data, name)
+
+                if data is not None:
+                    print("Accumulating:", name)
+                    sums, mdays = self.add_sums(sums, mdays, data)
+
+            # A piece is done once every month it holds data for is accumulated
+            done.extend(names)
+            checkpoint_due = time.perf_counter() - last_checkpoint > self.checkpoint_interval
+            if self.checkpoint is not None and sums is not None and checkpoint_due:
+                self.save_checkpoint(sums, mdays, template, done)
+                last_checkpoint = time.perf_counter()
+
+        if months:
+            data, names = self.complete_months(months)
+            sums, mdays = self.add_sums(sums, mdays, data)
+            done.extend(names)
+
+        if self.open_year is not None:
+            sums = close_year(sums, self._var)
+            self.open_year = None
+
+        if self.prefetcher is not None:
+            summary = self.prefetcher.summary()
+            print(f"\nPrefetched {format_bytes(summary['bytes_read'])}, waited {summary['wait_s']:.1f} s on reads")
+
+        return sums, mdays, template
+
+    def add_sums(self, sums, mdays, data):
+        """
+        Add the days-weighted sums (and statistics) of monthly data to the running monthly sums.
+        """
+        file_sums, file_days = month_sums(data[self._var], kernel=self.kernel)
+        if self.stats:
+            file_sums = file_sums.merge(month_stats(data, self._var))
+        file_sums = file_sums.load()
+
+        if sums is None:
+            sums, mdays = file_sums, file_days
+        else:
+            sums, mdays = combine_sums(sums, file_sums, self._var), mdays + file_days
+        if self.stats:
+            sums = self.add_years(sums, data)
+        return sums, mdays
+
+    def add_years(self, sums, data):
+        """
+        Add monthly data to the sums of the year being read; a later year closes it into the yearly states.
+        """
+        for year, part in data.groupby("time.year"):
+            if year != self.open_year:
+                if self.open_year is not None:
+                    sums = close_year(sums, self._var)
+                self.open_year = int(year)
+
+            part_sums = open_sums(part, self._var).load()
+            if f"{self._var[0]}_osum" in sums:
+                part_sums = sums[list(part_sums)] + part_sums
+            sums = sums.assign(part_sums)
+        return sums
+
+    def complete_months(self, months, data=None, name=None):
+        """
+        Add the samples of a sub-monthly piece to the open months.
+
+        Returns the means of the months that the piece completes (all open months when no piece is
+        given) and the pieces that no open month needs anymore. Pieces come in time order, so a month
+        is complete once a later month is read.
+        """
+        last = None
+        if data is not None:
+            pieces = month_pieces(data, self._var)
+            for key, (sums, counts, first) in pieces.items():
+                if key in months:
+                    prev_sums, prev_counts, first, names = months[key]
+                    sums, counts, names = prev_sums + sums, prev_counts + counts, names + [name]
+                else:
+                    names = [name]
+                months[key] = sums, counts, first, names
+            last = max(pieces)
+
+        complete = [key for key in sorted(months) if last is None or key < last]
+        if not complete:
+            return None, []
+
+        means, names = [], []
+        for key in complete:
+            sums, counts, first, month_names = months.pop(key)
+            print(f"Month {key[0]:04d}-{key[1]:02d}: {int(counts.to_array().max())} samples")
+            means.append((sums / counts.where(counts > 0)).expand_dims(time=first.values))
+            names += [x for x in month_names if x not in names]
+            self.last_month = key[0] * 100 + key[1]
+
+        open_names = {x for _, _, _, month_names in months.values() for x in month_names}
+        return xr.concat(means, dim="time"), [x for x in names if x not in open_names]
+
+    def stream_inputs(self, flist, drop, decode_times=True):
+        """
+        Pieces read by the streaming backend: each NetCDF file, or a year of monthly time steps
+        (a time chunk of sub-monthly ones) of each Zarr store.
+
+        With prefetching the next files are read into the page cache, or copied to the scratch
+        directory, while the current one is reduced.
+        """
+        if self.prefetch:
+            self.prefetcher = Prefetcher(flist, self.prefetch, self.prefetch_workers, self.scratch)
+            files = iter(self.prefetcher)
+        else:
+            files = ((filename, filename) for filename in flist)
+
+        for filename, path in files:
+            if not is_zarr(filename):
+                with xr.open_dataset(path, drop_variables=drop, decode_times=decode_times) as data:
+                    yield str(filename), data
+                continue
+
+            with xr.open_zarr(filename, drop_variables=drop, decode_times=decode_times) as data:
+                step = 12 if self.stream == "h0" or data.chunks.get("time") is None else data.chunks["time"][0]
+                for i in range(0, data.sizes["time"], step):
+                    yield f"{filename} [{i}:{i + step}]", data.isel(time=slice(i, i + step))
+
+    def acc_path(self, end):
+        outpath = get_dir_path(self.outpath)
+        group = f"_group{self.group}" if self.ngroups > 1 else ""
+        return outpath / f"{self.case}_{self.start}01_{end}12{group}_climo_acc.nc"
+
+    def read_acc(self):
+        """
+        Read the accumulator sidecar of the latest earlier run with the same case and start year.
+        """
+        prefix, suffix = f"{self.case}_{self.start}01_", "12_climo_acc.nc"
+        found = {}
+        for filepath in get_dir_path(self.outpath).glob(f"{prefix}*{suffix}"):
+            end = filepath.name[len(prefix):-len(suffix)]
+            if end.isdigit() and int(end) < int(self.end):
+                found[int(end)] = (end, filepath)
+
+        if not found:
+            print("\nNo earlier accumulator found; computing from", self.start)
+            return None
+
+        end, filepath = found[max(found)]
+        print("\nReading accumulator:\n", str(filepath))
+        acc = xr.load_dataset(filepath)
+
+        acc_vars = acc_variables(acc)
+        self.dtypes = self.pop_dtypes(acc, acc_vars)
+        if self._var is None:
+            self._var = acc_vars
+        elif not set(self._var).issubset(acc_vars):
+            print("Accumulator does not hold all requested variables; computing from", self.start)
+            return None
+
+        if self.stats and not all(f"{var}_m2" in acc and f"{var}_ym2" in acc for var in self._var):
+            print("Accumulator does not hold the statistics; computing from", self.start)
+            return None
+
+        return acc, end
+
+    def pop_dtypes(self, acc, acc_vars):
+        """
+        Input dtypes of the accumulated variables, removed from their attributes.
+        """
+        return {var: np.dtype(acc[var].attrs.pop("input_dtype", "float64")) for var in acc_vars}
+
+    def split_acc(self, acc):
+        """
+        Sums, days per month and template of an accumulator; sets the variables, static fields and dtypes.
+        """
+        acc_vars = acc_variables(acc)
+        self.dtypes = self.pop_dtypes(acc, acc_vars)
+        self._var = acc_vars
+        accumulated = [var for var in acc.data_vars if {"month", "year_period"} & set(acc[var].dims)]
+        self.static_vars = {var: acc[var] for var in acc.data_vars if var not in accumulated}
+        sums = acc[[var for var in accumulated if var != "month_days"]]
+        return sums, acc["month_days"], acc[acc_vars]
+
+    def save_acc(self, filepath, sums, mdays):
+        acc = sums.copy(deep=False).assign(month_days=mdays).assign(self.static_vars)
+        acc.attrs.update({"start": self.start, "end": self.end})
+        if self.ngroups > 1:
+            acc.attrs.update({"group": self.group, "ngroups": self.ngroups})
+        if self.last_month is not None:
+            acc.attrs["last_month"] = self.last_month
+        if self.open_year is not None:
+            acc.attrs["open_year"] = self.open_year
+        for var, dtype in self.dtypes.items():
+            acc[var].attrs["input_dtype"] = str(dtype)
+
+        # Sums stay float64 so that later updates do not lose precision
+        encoding = nc_encoding(acc, self.compression, self.complevel, self.shuffle)
+
+        with self.profiler.stage("write_acc"), NC_WRITE_LOCK:
+            print("\nSaving accumulator:\n", str(filepath))
+            acc.to_netcdf(tmp_path(filepath), encoding=encoding)
+            replace_atomic(tmp_path(filepath), filepath)
 
+    def write_acc(self):
+        filepath = self.acc_path(self.end)
+        self.save_acc(filepath, *self.acc)
+        if self.checkpoint is not None:
+            self.checkpoint.complete(filepath)
+
+    def save_checkpoint(self, sums, mdays, template, files, complete=False):
+        """
+        Checkpoint the monthly sums of the given input files.
+        """
+        self.save_acc(self.checkpoint.acc_path, retain_attr(template, sums.copy(deep=False)), mdays)
+        self.checkpoint.accumulated(files, complete)
+
+    def start_checkpoint(self):
+        """
+        Resume the checkpoint of an earlier run with the same inputs and options, or start a new one.
+        """
+        if self.merge:
+            flist = [filepath for accs in self.group_accs().values() for filepath in accs.values()]
+        else:
+            flist = self.get_files(self.start)
+
+        group = f"_group{self.group}" if self.ngroups > 1 else ""
+        prefix = get_dir_path(self.outpath) / f"{self.case}_{self.start}01_{self.end}12{group}"
+        key = fingerprint(flist, {option: getattr(self, option) for option in CHECKPOINT_OPTIONS})
+        self.set_periods()
+        self.checkpoint = Checkpoint(
+            f"{prefix}_genclimo_checkpoint.json", f"{prefix}_checkpoint_acc.nc", key, self.outputs()
+        )
+
+    def groups_path(self):
+        return Path(self.groups_dir) if self.groups_dir is not None else get_dir_path(self.outpath) / "genclimo_groups"
+
+    def group_accs(self):
+        """
+        Accumulators of the job-array tasks of this case within the years start..end, as
+        {(start, end): {group: filepath}} sorted by start year.
+        """
+        pattern = re.compile(rf"{re.escape(self.case)}_(\d+)01_(\d+)12(?:_group(\d+))?_climo_acc\.nc")
+        found = {}
+        for filepath in self.groups_path().glob(f"{self.case}_*_climo_acc.nc"):
+            match = pattern.fullmatch(filepath.name)
+            if match is None:
+                continue
+            first, last, group = match.groups()
+            if int(self.start) <= int(first) and int(last) <= int(self.end):
+                found.setdefault((first, last), {})[int(group or 0)] = filepath
+            else:
+                print("Skipping accumulator outside the years requested:", str(filepath))
+
+        return dict(sorted(found.items(), key=lambda item: int(item[0][0])))
+
+    def check_group_accs(self, ranges):
+        """
+        Check that the year ranges of the accumulators cover start..end once and each has every variable group.
+        """
+        if not ranges:
+            raise ValueError(f"No accumulators of {self.case} for {self.start}-{self.end} in {self.groups_path()}.")
+
+        year = int(self.start)
+        for first, last in ranges:
+            if int(first) != year:
+                problem = "overlap" if int(first) < year else "leave a gap"
+                raise ValueError(f"Accumulator year ranges {', '.join(f'{a}-{b}' for a, b in ranges)} {problem} at {first}.")
+            year = int(last) + 1
+        if year != int(self.end) + 1:
+            raise ValueError(f"Accumulators end in {year - 1}, not {self.end}.")
+
+        for (first, last), accs in ranges.items():
+            ngroups = max(acc.attrs.get("ngroups", 1) for acc in accs.values())
+            missing = sorted(set(range(max(ngroups, max(accs) + 1))) - set(accs))
+            if missing:
+                raise ValueError(f"Accumulators of {first}-{last} miss the variable groups {missing}.")
+            for group, acc in accs.items():
+                if (acc.attrs["start"], acc.attrs["end"]) != (first, last):
+                    raise ValueError(f"Accumulator of group {group} of {first}-{last} holds {acc.attrs['start']}-{acc.attrs['end']}.")
+
+    def merge_acc(self):
+        """
+        Combine the accumulators of the job-array tasks: variable groups are merged, year ranges summed.
+
+        The accumulators are opened lazily, one chunk per month, so that the climos are written period
+        by period without holding the sums of every group on the merge node.
+        """
+        found = self.group_accs()
+        print("\nMerging accumulators:\n", [str(filepath) for files in found.values() for filepath in files.values()])
+        ranges = {
+            years: {group: xr.open_dataset(filepath, chunks={"month": 1}) for group, filepath in sorted(files.items())}
+            for years, files in found.items()
+        }
+        self.check_group_accs(ranges)
+
+        sums, mdays, template = None, None, None
+        for accs in ranges.values():
+            accs = list(accs.values())
+            # Every variable group of a year range holds the same month_days and static fields
+            acc = xr.merge(accs, compat="override", combine_attrs="override")
+
+            if template is None:
+                sums, mdays, template = self.split_acc(acc)
+            else:
+                sums, mdays = combine_sums(sums, acc, self._var), mdays + acc["month_days"]
+
+        return sums, mdays.load(), template
+
+    def monthly_sums(self):
+        """
+        Days-weighted monthly sums, days per month and template, updated from an earlier accumulator when incremental.
+        """
+        start = self.start
+        previous = self.read_acc() if self.incremental else None
+        if previous is not None:
+            acc, end = previous
+            start = str(int(end) + 1).zfill(len(str(self.start)))
+            print("Updating climos ending in", end, "with years from", start)
+
+        if self.merge:
+            with self.profiler.stage("merge_acc"):
+                sums, mdays, template = self.merge_acc()
+        elif self.backend == "streaming":
+            print("\nStreaming monthly means file by file.")
+            sums, mdays, template = self.stream_climo(start)
+        else:
+            template = self.make_climo(start)
+            print("\nCalculating monthly means.")
+            with self.profiler.stage("means"):
+                sums, mdays = month_sums(template, kernel=self.kernel, block_bytes=self.block_bytes())
+                if self.stats:
+                    sums = sums.merge(month_stats(template, self._var)).merge(year_stats(template, self._var))
+
+        if previous is not None:
+            sums, mdays = combine_sums(sums, acc, self._var), mdays + acc["month_days"]
+
+        # The sidecar of a job-array task is its only output, and merging is cheap
+        if self.checkpoint is not None and not (self.acc_only or self.merge):
+            with self.profiler.stage("compute"):
+                sums, mdays = sums.load(), mdays.load()
+            self.save_checkpoint(sums, mdays, template, [], complete=True)
+
+        return sums, mdays, template
+
+    def monthly_means(self):
+        """
+        Monthly means and days per month.
+        """
+        if self.checkpoint is not None and self.checkpoint.acc_complete:
+            print("\nResuming from the checkpointed monthly sums.")
+            sums, mdays, template = self.split_acc(xr.load_dataset(self.checkpoint.acc_path))
+        else:
+            sums, mdays, template = self.monthly_sums()
+
+        if self.incremental or self.acc_only:
+            # Keep the updated sums in memory for the sidecar instead of recomputing them
+            with self.profiler.stage("compute"):
+                sums, mdays = retain_attr(template, sums.load()), mdays.load()
+            self.acc = sums, mdays
+
+        mon = (sums[self._var] / mdays).sel(month=mdays.month[mdays > 0])
+        mon = retain_attr(template, attach_lev(template, mon))
+        if self.stats:
+            self.stat_sums = retain_attr(template, attach_lev(template, sums.sel(month=mon.month)))
+        return mon, mdays.sel(month=mon.month)
+
+    def climo_path(self, tag, num_tag):
         im, fm = num_tag.split("-")
         filename = f"{self.case}_{tag}_{self.start}{im}_{self.end}{fm}_climo.nc"
-        filepath = self.outpath / filename
+        return get_dir_path(self.outpath) / filename
 
-        print("\nSaving climo file:\n", str(filepath))
-        data.isel(time=ind).load().to_netcdf(filepath)
+    def to_nc(self, ind, tag, num_tag, data, ts):
+        self.outpath = get_dir_path(self.outpath)
+        filepath = self.climo_path(tag, num_tag)
 
-    def apply_means(self):
-        data = self.make_climo()
+        data = data.isel(time=ind)
+        dtypes = self.output_dtypes() if self.dtype == "input" else None
+        encoding = nc_encoding(data, self.compression, self.complevel, self.shuffle, dtypes)
+
+        # HDF5 is not thread-safe: only one file is written at a time.
+        # A job killed while writing leaves only a temporary file behind.
+        with NC_WRITE_LOCK:
+            print("\nSaving climo file:\n", str(filepath))
+            data.to_netcdf(tmp_path(filepath), encoding=encoding)
+            replace_atomic(tmp_path(filepath), filepath)
+
+        if self.checkpoint is not None:
+            self.checkpoint.complete(filepath)
+
+    def output_dtypes(self):
+        """
+        Input dtypes of the climo variables and of their statistics.
+        """
+        dtypes = dict(self.dtypes)
+        for var in self._var:
+            dtypes.update({f"{var}_{stat}": self.dtypes[var] for stat in self.stats or [] if stat != "count"})
+        return dtypes
+
+    def zarr_path(self):
+        return get_dir_path(self.outpath) / f"{self.case}_{self.start}01_{self.end}12_climo.zarr"
+
+    def to_zarr(self, data):
+        """
+        Write all periods to a single Zarr store with one chunk per period and level.
+        """
+        filepath = self.zarr_path()
+
+        data = data.isel(time=slice(0, self.prs)).drop_vars("time", errors="ignore").rename({"time": "period"})
+        data = data.assign_coords(period=self.tags, months=("period", self.numTags))
+        data = data.chunk({dim: 1 if dim in ["period", "lev"] else -1 for dim in data.dims})
+
+        dtypes = self.output_dtypes() if self.dtype == "input" else {}
+        encoding = {
+            var: {"dtype": dtypes[var]}
+            for var in data.data_vars
+            if var in dtypes and dtypes[var] != data[var].dtype
+        }
 
+        # Dask writes the chunks concurrently
+        print("\nSaving climo store:\n", str(filepath))
+        data.to_zarr(tmp_path(filepath), mode="w", encoding=encoding)
+        replace_atomic(tmp_path(filepath), filepath)
+
+        if self.checkpoint is not None:
+            self.checkpoint.complete(filepath)
+
+    def regional_path(self):
+        return get_dir_path(self.outpath) / f"{self.case}_{self.start}01_{self.end}12_regional_climo.nc"
+
+    def read_landfrac(self):
+        """
+        Land fraction averaged over the first input file, for climos without it.
+        """
+        with open_input(self.get_files(self.start)[0], decode_times=False) as data:
+            name = next((name for name in LANDFRAC_NAMES if name in data), None)
+            return data[name].mean("time").load() if name is not None else None
+
+    def write_regional(self, data):
+        """
+        Write the area-weighted means of the climos over the requested regions as one table.
+        """
+        filepath = self.regional_path()
+        if self.checkpoint is not None and self.checkpoint.done(filepath):
+            return
+
+        data = data.isel(time=slice(0, self.prs))
+        landfrac = next((name for name in LANDFRAC_NAMES if name in data), None)
+        landfrac = data[landfrac].mean("time") if landfrac is not None else self.read_landfrac
+        area = data["area"] if "area" in data else None
+        weights = region_weights(data["lat"], data["lon"], area, landfrac, self.regions, get_dir_path(self.outpath))
+
+        with self.profiler.stage("regions"):
+            means = regional_means(data[self._var], weights).load()
+        means = means.drop_vars("time", errors="ignore").rename({"time": "period"}).transpose("period", "region", ...)
+        means = means.assign_coords(period=self.tags[:self.prs], months=("period", self.numTags[:self.prs]))
+        means.attrs = dict(data.attrs)
+
+        dtypes = self.output_dtypes() if self.dtype == "input" else None
+        encoding = nc_encoding(means, self.compression, self.complevel, self.shuffle, dtypes)
+        with NC_WRITE_LOCK:
+            print("\nSaving regional means:\n", str(filepath))
+            means.to_netcdf(tmp_path(filepath), encoding=encoding)
+            replace_atomic(tmp_path(filepath), filepath)
+
+        if self.checkpoint is not None:
+            self.checkpoint.complete(filepath)
+
+    def set_periods(self):
         if self.ts == "sea":
-            print("\nCalculating seasonal means.")
-            ds = smean(data)
-            ds = ds.rename({"season": "time"})
             self.prs = 4
             self.tags = ["DJF", "JJA", "MAM", "SON"]
             self.numTags = ["01-12", "06-08", "03-05", "09-11"]
 
         elif self.ts == "mon":
-            print("\nCalculating monthly means.")
-            ds = mmean(data)
-            ds = ds.rename({"month": "time"})
             self.prs = 12
             self.tags = [f"{i:02d}" for i in range(1, 13)]
             self.numTags = [f"{i:02d}-{i:02d}" for i in range(1, 13)]
 
+        elif self.ts == "all":
+            self.prs = 17
+            self.tags = ["ANN", "DJF", "JJA", "MAM", "SON"] + [f"{i:02d}" for i in range(1, 13)]
+            self.numTags = ["01-12", "01-12", "06-08", "03-05", "09-11"] + [f"{i:02d}-{i:02d}" for i in range(1, 13)]
+
         else:
-            print("\nCalculating annual means.")
-            ny = int(self.end) - int(self.start) + 1
-            ds = amean(data, years=ny)
-            ds = ds.rename({"year": "time"})
             self.prs = 1
             self.tags = ["ANN"]
             self.numTags = ["01-12"]
-        
+
+    def derive_means(self, mon, mdays):
+        """
+        Derive the requested climos from monthly means and the number of days in each month.
+        """
+        if self.ts == "mon":
+            return mon.rename({"month": "time"})
+
+        print("Deriving seasonal and annual means from the monthly means.")
+        if self.ts == "sea":
+            return smean_from_mmean(mon, mdays).rename({"season": "time"})
+
+        ann = amean_from_mmean(mon, mdays).rename({"year": "time"})
+        if self.ts != "all":
+            return ann
+
+        sea = smean_from_mmean(mon, mdays).rename({"season": "time"})
+        mon = mon.rename({"month": "time"})
+        ds = xr.concat([ann, sea.drop_vars("time"), mon.drop_vars("time")], dim="time")
+        return ds.assign_coords(time=self.tags)
+
+    def month_stat_sums(self, data):
+        """
+        Monthly sums and statistics states of the data, for the statistics of climos reduced directly.
+        """
+        sums, mdays = month_sums(data, kernel=self.kernel, block_bytes=self.block_bytes())
+        sums = sums.merge(month_stats(data, self._var)).merge(year_stats(data, self._var))
+        sums = sums.sel(month=mdays.month[mdays > 0])
+        self.stat_sums = retain_attr(data, attach_lev(data, sums))
+
+    def derive_stats(self):
+        """
+        Derive the requested statistics of each period from the monthly sums and statistics states.
+        """
+        keys = {"mon": ["month"], "sea": ["season"], "all": ["year", "season", "month"]}.get(self.ts, ["year"])
+        stats = [stats_from_sums(self.stat_sums, self._var, self.stats, key).rename({key: "time"}) for key in keys]
+        if len(stats) == 1:
+            return stats[0]
+
+        ds = xr.concat([stats[0]] + [x.drop_vars("time") for x in stats[1:]], dim="time")
+        return ds.assign_coords(time=self.tags)
+
+    def apply_means(self):
+        self.set_periods()
+        self.stat_sums = None
+
+        unknown = sorted(set(self.stats or []) - set(STATISTICS))
+        if unknown:
+            raise ValueError(f"Unknown statistics {unknown} (available: {', '.join(STATISTICS)}).")
+
+        # Resumable runs checkpoint the monthly sums before the climos are written
+        monthly = self.incremental or self.acc_only or self.merge or self.checkpoint is not None
+        if self.backend == "streaming" or monthly or self.ts == "all":
+            ds = self.derive_means(*self.monthly_means())
+
+        elif self.ts == "sea":
+            data = self.make_climo()
+            print("\nCalculating seasonal means.")
+            with self.profiler.stage("means"):
+                ds = smean(data, kernel=self.kernel, block_bytes=self.block_bytes())
+            ds = ds.rename({"season": "time"})
+
+        elif self.ts == "mon":
+            data = self.make_climo()
+            print("\nCalculating monthly means.")
+            with self.profiler.stage("means"):
+                ds = mmean(data, kernel=self.kernel, block_bytes=self.block_bytes())
+            ds = ds.rename({"month": "time"})
+
+        else:
+            data = self.make_climo()
+            print("\nCalculating annual means.")
+            with self.profiler.stage("means"):
+                ds = amean(data, kernel=self.kernel, block_bytes=self.block_bytes())
+            ds = ds.rename({"year": "time"})
+
+        if self.stats and self.stat_sums is None:
+            # The means above are left as they are without statistics, only the states are added
+            with self.profiler.stage("means"):
+                self.month_stat_sums(data)
+
+        if self.stats and not self.acc_only:
+            ds = ds.merge(self.derive_stats())
+
         # Attach static vars back
         ds = ds.assign(self.static_vars)
 
         return ds
 
-    def get_nc(self):
+    def write_report(self):
+        group = f"_group{self.group}" if self.ngroups > 1 else ""
+        filename = f"{self.case}_{self.start}01_{self.end}12{group}_genclimo_report.json"
+        filepath = get_dir_path(self.outpath) / filename
+        print("\nSaving report:\n", str(filepath))
+        self.profiler.write(
+            filepath,
+            case=self.case,
+            start=self.start,
+            end=self.end,
+            ts=self.ts,
+            model=self.mod,
+            backend=self.backend,
+            kernel=self.kernel,
+            files=self.nfiles,
+            variables=len(self._var) if self._var is not None else 0,
+            chunk_plan=self.chunk_plan,
+            prefetch=self.prefetcher.summary() if self.prefetcher is not None else None,
+        )
+
+    def outputs(self):
+        """
+        Files written by this run.
+        """
+        if self.acc_only:
+            return [self.acc_path(self.end)]
+
+        sinks = self.sink_list()
+        outputs = []
+        if "nc" in sinks:
+            outputs += [self.climo_path(self.tags[i], self.numTags[i]) for i in range(self.prs)]
+        if "zarr" in sinks:
+            outputs.append(self.zarr_path())
+        if "regional" in sinks:
+            outputs.append(self.regional_path())
+        if self.incremental:
+            outputs.append(self.acc_path(self.end))
+        return outputs
+
+    def write_nc(self, ds):
+        """
+        Write one NetCDF file per period from the computed climos, one after the other (HDF5 writes are serial).
+        """
+        periods = range(self.prs)
+        if self.checkpoint is not None:
+            periods = [i for i in periods if not self.checkpoint.done(self.climo_path(self.tags[i], self.numTags[i]))]
+
+        with self.profiler.stage("write"):
+            for i in periods:
+                self.to_nc(i, self.tags[i], self.numTags[i], ds, self.ts)
+
+    def write_zarr(self, ds):
+        with self.profiler.stage("write"):
+            self.to_zarr(ds)
+
+    def sink_list(self):
+        """
+        Writers of the climos: the sinks given, or the climo files in the output format and the regional means.
+        """
+        if self.sinks is not None:
+            sinks = list(self.sinks)
+        else:
+            sinks = [self.output_format] + (["regional"] if self.regions else [])
+
+        unknown = [sink for sink in sinks if not callable(sink) and sink not in SINKS]
+        if unknown:
+            raise ValueError(f"Unknown sinks {unknown} (available: {', '.join(SINKS)} or a callable).")
+        if "regional" in sinks and not self.regions:
+            raise ValueError("The regional sink needs regions.")
+        return sinks
+
+    def period_climos(self, ds):
+        return {self.tags[i]: ds.isel(time=i) for i in range(self.prs)}
+
+    def get_climos(self, compute=True):
+        """
+        Climos of the requested periods as {tag: Dataset} with the static variables attached, without
+        writing any file. The datasets are dask-backed unless compute, which evaluates the reduction
+        graph once for all periods.
+        """
+        ds = self.apply_means()
+        if compute:
+            with self.profiler.stage("compute"):
+                ds = ds.load()
+        return self.period_climos(ds)
+
+    def write_climos(self):
+        self.set_periods()
+        sinks = self.sink_list()
+        done = self.checkpoint is not None and all(self.checkpoint.done(f) for f in self.outputs())
+        if done and not any(callable(sink) for sink in sinks):
+            print("\nEvery output was written by an earlier run; nothing to do.")
+            return
+
+        for region in self.regions or []:
+            parse_region(region)
+        if self.compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {self.compression} (available: {', '.join(COMPRESSIONS)}).")
+        if self.dtype not in DTYPES:
+            raise ValueError(f"Unknown dtype {self.dtype} (available: {', '.join(DTYPES)}).")
+
         ds = self.apply_means()
 
-        for i in range(self.prs):
-            self.to_nc(i, self.tags[i], self.numTags[i], ds, self.ts)
+        if self.acc_only:
+            self.write_acc()
+            return
+
+        if "zarr" in sinks:
+            self.write_zarr(ds)
+            # The other sinks read the store rather than computing the climos again
+            ds = xr.open_zarr(self.zarr_path()).rename({"period": "time"}).drop_vars("months")
+        elif self.merge:
+            # Each period is computed from the accumulators on disk as it is written
+            print("\nWriting climos from the accumulators.")
+        else:
+            # Evaluate the reduction graph once; every sink then writes from memory
+            print("\nComputing climos.")
+            with self.profiler.stage("compute"):
+                ds = ds.load()
+
+        for sink in sinks:
+            if callable(sink):
+                sink(self.period_climos(ds))
+            elif sink != "zarr":
+                getattr(self, SINKS[sink])(ds)
+
+        if self.incremental:
+            self.write_acc()
+
+    def get_nc(self):
+        if self.resume:
+            self.start_checkpoint()
 
-        # processes = []
+        with self.profiler.capture_dask() if self.dask_profile else nullcontext():
+            self.write_climos()
 
-        # for i in range(self.prs):
-        #     p = mp.Process(target=self.to_nc, args=(i, self.tags[i], self.numTags[i], ds, self.ts))
-        #     p.start()
-        #     processes.append(p)
+        if self.checkpoint is not None:
+            self.checkpoint.finish()
 
-        # for process in processes:
-        #     process.join()
+        if self.report:
+            self.write_report()
@@ -0,0 +1,110 @@
+import os
+import time
+import shutil
+import tempfile
+
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Read size used to pull files into the page cache
+BLOCK_SIZE = 16 * 2**20
+
+
+def read_through(filename):
+    """
+    Read a file once so that it is in the page cache when it is opened. Returns the bytes read.
+    """
+    nbytes = 0
+    buffer = bytearray(BLOCK_SIZE)
+    with open(filename, "rb", buffering=0) as file:
+        while True:
+            n = file.readinto(buffer)
+            if not n:
+                return nbytes
+            nbytes += n
+
+
+class Prefetcher:
+    """
+    Reads the next input files in background threads while the current one is reduced.
+
+    Iterating yields each file with the path to open it at: the file itself once it is in the page
+    cache, or its copy in a scratch directory, deleted once the next file is requested. At most
+    depth files are read ahead of the one being reduced, by up to workers threads.
+    """
+
+    def __init__(self, files, depth=2, workers=2, scratch=None):
+        self.files = list(files)
+        self.depth = depth
+        self.workers = workers
+        self.scratch = scratch
+        self.wait_s = 0.0
+        self.bytes_read = 0
+        self._dir = None
+
+    def fetch(self, filename):
+        # Zarr stores are read chunk by chunk as they are reduced
+        if Path(filename).is_dir():
+            return filename, 0
+
+        if self._dir is None:
+            return filename, read_through(filename)
+
+        copy = self._dir / Path(filename).name
+        try:
+            shutil.copyfile(filename, copy)
+        except OSError as err:
+            # A full scratch disk only loses the copy, the file is then read in place
+            print(f"Could not copy {filename} to scratch ({err}), reading it in place.")
+            copy.unlink(missing_ok=True)
+            return filename, 0
+        return copy, os.path.getsize(copy)
+
+    def __iter__(self):
+        if self.scratch is not None:
+            Path(self.scratch).mkdir(parents=True, exist_ok=True)
+            self._dir = Path(tempfile.mkdtemp(prefix="genclimo_", dir=self.scratch))
+
+        pool = ThreadPoolExecutor(self.workers, thread_name_prefix="prefetch")
+        try:
+            for filename, path in self._ordered(pool):
+                try:
+                    yield filename, path
+                finally:
+                    if path != filename:
+                        Path(path).unlink(missing_ok=True)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            if self._dir is not None:
+                shutil.rmtree(self._dir, ignore_errors=True)
+                self._dir = None
+
+    def _ordered(self, pool):
+        """
+        Files in order as their reads complete, keeping depth reads in flight.
+        """
+        pending = deque()
+        for filename in self.files:
+            pending.append((filename, pool.submit(self.fetch, filename)))
+            if len(pending) > self.depth:
+                yield self._result(*pending.popleft())
+
+        while pending:
+            yield self._result(*pending.popleft())
+
+    def _result(self, filename, future):
+        start = time.perf_counter()
+        path, nbytes = future.result()
+        self.wait_s += time.perf_counter() - start
+        self.bytes_read += nbytes
+        return filename, path
+
+    def summary(self):
+        return {
+            "depth": self.depth,
+            "workers": self.workers,
+            "scratch": str(self.scratch) if self.scratch is not None else None,
+            "bytes_read": self.bytes_read,
+            "wait_s": self.wait_s,
+        }
@@ -0,0 +1,148 @@
+import json
+import time
+import socket
+import resource
+from datetime import datetime
+from contextlib import contextmanager
+
+from dask.utils import key_split
+
+
+def proc_io():
+    """
+    Bytes read and written by this process through read/write calls (network filesystems included).
+    """
+    try:
+        with open("/proc/self/io") as file:
+            io = dict(line.split(": ") for line in file.read().splitlines())
+        return int(io["rchar"]), int(io["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process (Linux only).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """
+    Peak resident set size in bytes since the last reset, or since the process started.
+    """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageProfiler:
+    """
+    Wall time, peak memory and IO per pipeline stage, with an optional dask task profile.
+
+    Stages with the same name are accumulated. Memory and IO are those of the main process:
+    work done on distributed workers only shows up in the dask profile. When other cases run in the
+    process at the same time (shared), the peak cannot be reset per stage without resetting theirs,
+    so stages only record wall time and the IO of the whole process.
+    """
+
+    def __init__(self, shared=False):
+        self.shared = shared
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.dask = None
+        self._active = []
+
+    def _update_peaks(self):
+        peak = peak_rss()
+        for record in self._active:
+            record["peak"] = max(record["peak"], peak)
+
+    @contextmanager
+    def stage(self, name):
+        # Enclosing stages keep the peak reached before the reset
+        if not self.shared:
+            self._update_peaks()
+            reset_peak_rss()
+
+        record = {"peak": 0}
+        self._active.append(record)
+        read_start, written_start = proc_io()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_time
+            read_end, written_end = proc_io()
+            self._update_peaks()
+            self._active.remove(record)
+
+            stats = self.stages.setdefault(
+                name, {"calls": 0, "wall_s": 0.0, "peak_rss_bytes": 0, "bytes_read": 0, "bytes_written": 0}
+            )
+            stats["calls"] += 1
+            stats["wall_s"] += wall
+            stats["peak_rss_bytes"] = None if self.shared else max(stats["peak_rss_bytes"], record["peak"])
+            stats["bytes_read"] += read_end - read_start
+            stats["bytes_written"] += written_end - written_start
+
+    @contextmanager
+    def capture_dask(self):
+        """
+        Record task counts and compute time per task prefix from the dask profiler or task stream.
+        """
+        try:
+            from distributed import default_client, get_task_stream
+            client = default_client()
+        except (ImportError, ValueError):
+            client = None
+
+        if client is not None:
+            with get_task_stream(client) as stream:
+                yield
+            tasks = [
+                (task["key"], sum(s["stop"] - s["start"] for s in task["startstops"] if s["action"] == "compute"))
+                for task in stream.data
+            ]
+        else:
+            from dask.diagnostics import Profiler
+
+            with Profiler() as profiler:
+                yield
+            tasks = [(result.key, result.end_time - result.start_time) for result in profiler.results]
+
+        summary = {}
+        for key, duration in tasks:
+            stats = summary.setdefault(key_split(key), {"tasks": 0, "compute_s": 0.0})
+            stats["tasks"] += 1
+            stats["compute_s"] += duration
+        self.dask = dict(sorted(summary.items(), key=lambda item: -item[1]["compute_s"]))
+
+    def write(self, filepath, **meta):
+        report = {
+            "created": datetime.today().strftime("%Y-%m-%d %H:%M:%S"),
+            "host": socket.gethostname(),
+            **meta,
+            "total_wall_s": time.perf_counter() - self.started,
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "stages": self.stages,
+        }
+        if self.shared:
+            report["note"] = (
+                "Cases ran concurrently in this process: peak memory and IO are those of the whole "
+                "process, and per-stage peak memory is not recorded."
+            )
+        if self.dask is not None:
+            report["dask"] = self.dask
+
+        with open(filepath, "w") as file:
+            json.dump(report, file, indent=2)
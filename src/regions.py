@@ -0,0 +1,146 @@
+import hashlib
+import threading
+import numpy as np
+import xarray as xr
+
+from pathlib import Path
+
+# Latitude bands (south, north) of the named regions
+BANDS = {
+    "global": (-90, 90),
+    "nh": (0, 90),
+    "sh": (-90, 0),
+    "tropics": (-30, 30),
+    "nh_extratropics": (30, 90),
+    "sh_extratropics": (-90, -30),
+    "arctic": (60, 90),
+    "antarctic": (-90, -60),
+}
+SURFACES = ["land", "ocean"]
+LANDFRAC_NAMES = ["LANDFRAC", "landfrac"]
+
+# Weights of the grids seen by this run, shared by the cases processed together
+_WEIGHTS = {}
+_LOCK = threading.Lock()
+
+
+def parse_region(region):
+    """
+    Surface and latitude band of a region: a band name, land or ocean, both joined as <surface>_<band>
+    (ex: land_tropics), or a custom band <south>:<north> in degrees (ex: -60:-30).
+    """
+    surface, band = None, region
+    for name in SURFACES:
+        if region == name or region.startswith(f"{name}_"):
+            surface, band = name, region[len(name) + 1:] or "global"
+
+    if band in BANDS:
+        return surface, BANDS[band]
+    try:
+        south, north = (float(x) for x in band.split(":"))
+    except ValueError:
+        raise ValueError(
+            f"Unknown region {region} (available: {', '.join(list(BANDS) + SURFACES)}, "
+            "<surface>_<band> or <south>:<north>)."
+        )
+    return surface, (south, north)
+
+
+def array_key(*arrays):
+    """
+    Hash of the values of the arrays given (None are skipped).
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        if array is not None:
+            digest.update(np.ascontiguousarray(array.values).tobytes())
+    return digest.hexdigest()[:12]
+
+
+def grid_key(lat, lon, area=None):
+    return array_key(lat, lon, area)
+
+
+def build_weights(lat, lon, area, landfrac, regions):
+    """
+    Area weights of every region over the horizontal grid, normalised to sum to one.
+
+    Without an area variable (lat/lon grids) columns are weighted by the cosine of their latitude.
+    """
+    lat, lon = xr.broadcast(lat, lon)
+    if area is None:
+        area = np.cos(np.deg2rad(lat))
+
+    weights = []
+    for region in regions:
+        surface, (south, north) = parse_region(region)
+        weight = area.where((lat >= south) & (lat <= north), 0)
+        if surface is not None:
+            if landfrac is None:
+                raise ValueError(f"Region {region} needs the land fraction ({' or '.join(LANDFRAC_NAMES)}).")
+            weight = weight * (landfrac if surface == "land" else 1 - landfrac)
+        weights.append(weight / weight.sum())
+
+    weights = xr.concat(weights, dim="region").assign_coords(region=regions)
+    return weights.drop_vars([name for name in weights.coords if name != "region"]).astype(np.float64)
+
+
+def region_weights(lat, lon, area, landfrac, regions, cache_dir=None):
+    """
+    Region weights of a grid, built once and cached in memory and in the cache directory.
+
+    The cache is keyed by the coordinates and area of the grid. Land and ocean weights also record
+    the land fraction they were built with and are rebuilt when it changes. The land fraction is
+    only read for land and ocean regions: it can be passed as a function that reads it.
+    """
+    key = grid_key(lat, lon, area)
+    filepath = Path(cache_dir) / f".genclimo_regions_{key}.nc" if cache_dir is not None else None
+
+    with _LOCK:
+        weights = _WEIGHTS.get(key)
+        if weights is None and filepath is not None and filepath.exists():
+            weights = xr.load_dataarray(filepath)
+
+        needs_land = any(parse_region(region)[0] is not None for region in regions)
+        if needs_land:
+            landfrac = landfrac() if callable(landfrac) else landfrac
+            if weights is not None and weights.attrs.get("landfrac") != array_key(landfrac):
+                weights = None
+
+        if weights is None or not set(regions) <= set(weights.region.values):
+            print("\nBuilding region weights:", ", ".join(regions))
+            # Land and ocean weights are only kept when they are rebuilt with the current land fraction
+            known = [] if weights is None else [
+                x for x in weights.region.values if x not in regions and (needs_land or parse_region(x)[0] is None)
+            ]
+            weights = build_weights(lat, lon, area, landfrac if needs_land else None, known + list(regions))
+            if needs_land:
+                weights.attrs["landfrac"] = array_key(landfrac)
+            if filepath is not None:
+                try:
+                    weights.rename("weight").to_netcdf(filepath)
+                except OSError:
+                    pass
+
+        _WEIGHTS[key] = weights
+
+    return weights.sel(region=list(regions))
+
+
+def regional_means(data, weights):
+    """
+    Area-weighted means of every variable over the regions; missing values are left out of the weights.
+    """
+    dims = [dim for dim in weights.dims if dim != "region"]
+    means = {}
+    for var in data.data_vars:
+        if not set(dims) <= set(data[var].dims):
+            continue
+        valid = data[var].notnull()
+        total = xr.dot(data[var].fillna(0), weights, dim=dims)
+        norm = xr.dot(valid.astype(np.float64), weights, dim=dims)
+        means[var] = (total / norm.where(norm > 0)).astype(data[var].dtype)
+        means[var].attrs = dict(data[var].attrs)
+        means[var].attrs["cell_methods"] = "area: mean"
+
+    return xr.Dataset(means)
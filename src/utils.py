@@ -1,26 +1,94 @@
-import cftime
+import os
+import re
+import glob
 from datetime import datetime
 import xarray as xr
 import numpy as np
+import dask
+import dask.array as da
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from subprocess import Popen, PIPE, STDOUT
 
+try:
+    import numba
+except ImportError:
+    numba = None
 
-def shift_time(time_array):
+
+MONTH_SEASONS = {
+    1: "DJF", 2: "DJF", 3: "MAM", 4: "MAM", 5: "MAM", 6: "JJA",
+    7: "JJA", 8: "JJA", 9: "SON", 10: "SON", 11: "SON", 12: "DJF",
+}
+
+
+# Statistics of the monthly samples and the per-month states they are derived from
+STATISTICS = ["std", "var", "min", "max", "count"]
+STAT_STATES = ["wgt", "m2", "min", "max", "count"]
+
+# Yearly means of the annual and seasonal statistics: states per period, and per month of the year
+# still being read (streaming backend)
+YEAR_PERIODS = ["ANN", "DJF", "JJA", "MAM", "SON"]
+YEAR_STATES = ["ywgt", "ysum", "ym2", "ymin", "ymax", "ycount"]
+OPEN_STATES = ["osum", "owgt"]
+STAT_METHODS = {"std": "standard_deviation", "var": "variance", "min": "minimum", "max": "maximum", "count": "sum"}
+
+# Compressions and data types of the climo files
+COMPRESSIONS = ["zlib", "zstd", "none"]
+DTYPES = ["input", "float64"]
+
+# Half a day in the units of encoded times
+HALF_DAY = {"days": 0.5, "hours": 12.0, "minutes": 720.0, "seconds": 43200.0, "milliseconds": 43200e3}
+
+# Opening with decode_times=ENCODED_TIMES keeps the time axis as stored for shift_time
+ENCODED_TIMES = {"time": False, "time_bnds": False, "time_bounds": False}
+
+
+def time_bounds(data):
     """
-    Shift each timestamp in the given time array one month earlier.
+    The time bounds variable of the dataset, if any.
     """
-    return [
-        cftime.DatetimeNoLeap(
-            t.year - (t.month == 1),
-            12 if t.month == 1 else t.month - 1,
-            t.day,
-            t.hour,
-            t.minute,
-            t.second
-        )
-        for t in time_array
-    ]
+    for name in [data.time.attrs.get("bounds"), "time_bnds", "time_bounds"]:
+        if name is not None and name in data:
+            return data[name]
+    return None
+
+
+def encode_time(values, units, calendar):
+    """
+    Numeric times in the given units; times that are already encoded are returned as they are.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind not in "iuf":
+        values, _, _ = xr.coding.times.encode_cf_datetime(values, units, calendar)
+    return values.astype(np.float64)
+
+
+def shift_time(time, bounds=None):
+    """
+    Move time stamps from the end to the middle of their averaging periods, for any calendar.
+
+    The middle of the time bounds is used when given, otherwise the middle between consecutive
+    time stamps (half a day before a single time stamp). Times opened with ENCODED_TIMES are
+    shifted without decoding them first.
+    """
+    if time.dtype.kind in "iuf":
+        units = time.attrs.get("units", "days since 0001-01-01 00:00:00")
+        calendar = time.attrs.get("calendar", "standard")
+    else:
+        units = time.encoding.get("units", "days since 0001-01-01 00:00:00")
+        calendar = time.encoding.get("calendar", time.dt.calendar)
+
+    values = encode_time(time.values, units, calendar)
+    if bounds is not None:
+        middle = encode_time(bounds.values, units, calendar).mean(axis=-1)
+    elif len(values) > 1:
+        steps = np.diff(values)
+        middle = values - np.concatenate([steps[:1], steps]) / 2
+    else:
+        middle = values - HALF_DAY[units.split()[0]]
+
+    return xr.coding.times.decode_cf_datetime(middle, units, calendar)
 
 
 def retain_attr(data_in, data_out):
@@ -53,55 +121,521 @@ def retain_attr(data_in, data_out):
     return data_out
 
 
-def smean(data):
+def numpy_kernel(values, groups, weights, ngroups):
+    """
+    Weighted sums of (n, ntime) values into (n, ngroups) with a single matrix product.
+    """
+    # Match xarray's skipna sums without copying the data when there is nothing to skip
+    if np.isnan(values.sum()):
+        values = np.where(np.isnan(values), 0, values)
+
+    matrix = np.zeros((len(groups), ngroups))
+    matrix[np.arange(len(groups)), groups] = weights
+    return values @ matrix
+
+
+if numba is not None:
+    @numba.njit(nogil=True)
+    def numba_kernel(values, groups, weights, ngroups):
+        """
+        Weighted sums of (n, ntime) values into (n, ngroups) in one loop over the time axis.
+        """
+        out = np.zeros((values.shape[0], ngroups))
+        for i in range(values.shape[0]):
+            for t in range(values.shape[1]):
+                if not np.isnan(values[i, t]):
+                    out[i, groups[t]] += weights[t] * values[i, t]
+        return out
+else:
+    numba_kernel = None
+
+
+KERNELS = {"numpy": numpy_kernel, "numba": numba_kernel}
+
+
+def _reduce_block(block, groups, weights, ngroups, kernel):
+    """
+    Reduce one block holding the whole time axis as its last axis.
+    """
+    out = kernel(block.reshape(-1, block.shape[-1]), groups, weights, ngroups)
+    return out.reshape(block.shape[:-1] + (ngroups,))
+
+
+def _reduce_time(values, groups, weights, ngroups, kernel, block_bytes=None):
+    """
+    Apply the reduction kernel to blocks that each hold the whole time axis for a slab of the other dims.
+    Blocks are of block_bytes, or dask's automatic chunk size.
+    """
+    if isinstance(values, da.Array):
+        chunks = {axis: "auto" for axis in range(values.ndim - 1)}
+        chunks[values.ndim - 1] = -1
+        values = values.rechunk(chunks, block_size_limit=block_bytes)
+        return values.map_blocks(
+            _reduce_block,
+            groups=groups,
+            weights=weights,
+            ngroups=ngroups,
+            kernel=kernel,
+            chunks=values.chunks[:-1] + ((ngroups,),),
+            dtype=np.float64,
+        )
+
+    return _reduce_block(values, groups, weights, ngroups, kernel)
+
+
+def group_reduce(data, key, kernel="numpy", normalize=True, block_bytes=None):
+    """
+    Days-weighted sum of the data per time group (season, year or month) with a fused kernel.
+    """
+    if KERNELS.get(kernel) is None:
+        raise ValueError(f"Kernel '{kernel}' is not available (numba installed: {numba is not None}).")
+
+    labels, groups = np.unique(data[f"time.{key}"].values, return_inverse=True)
+    weights = data.time.dt.days_in_month.values.astype(np.float64)
+    if normalize:
+        weights = weights / np.bincount(groups, weights=weights)[groups]
+
+    time_vars = [var for var in data.data_vars if "time" in data[var].dims]
+    out = xr.apply_ufunc(
+        _reduce_time,
+        data[time_vars],
+        input_core_dims=[["time"]],
+        output_core_dims=[[key]],
+        kwargs={
+            "groups": groups,
+            "weights": weights,
+            "ngroups": len(labels),
+            "kernel": KERNELS[kernel],
+            "block_bytes": block_bytes,
+        },
+        dask="allowed",
+    )
+    return out.assign_coords({key: labels}).transpose(key, ...)
+
+
+def fused_mean(data, key, kernel="numpy", block_bytes=None):
+    """
+    Compute the mean per time group weighted by the number of days in each month with a fused kernel.
+    """
+    out = group_reduce(data, key, kernel, block_bytes=block_bytes)
+    return retain_attr(data, attach_lev(data, out))
+
+
+def attach_lev(data, out):
+    """
+    Attach the vertical levels of the input data to the reduced output.
+    """
+    if "lev" in data.dims:
+        list_of_lists = [lst if isinstance(lst, list) else [lst] for lst in data.lev.values]
+        lev_data = np.unique(np.concatenate(list_of_lists)).tolist()
+        out['lev'] = lev_data
+    return out
+
+
+def smean(data, kernel="xarray", block_bytes=None):
     """
     Compute seasonal mean weighted by the number of days in each month.
     """
+    if kernel != "xarray":
+        return fused_mean(data, "season", kernel, block_bytes)
+
     month_length = data.time.dt.days_in_month
     weights = month_length.groupby("time.season") / month_length.groupby("time.season").sum()
 
     np.testing.assert_allclose(weights.groupby("time.season").sum().values, np.ones(4))
 
     seasons = (data * weights).groupby("time.season").sum(dim="time")
-    
-    list_of_lists = [lst if isinstance(lst, list) else [lst] for lst in data.lev.values]
-    lev_data = np.unique(np.concatenate(list_of_lists)).tolist()
-    seasons['lev'] = lev_data
-    return retain_attr(data, seasons)
+    return retain_attr(data, attach_lev(data, seasons))
 
 
-def amean(data, years):
+def amean(data, kernel="xarray", block_bytes=None):
     """
-    Compute annual mean weighted by the number of days in each month.
+    Compute the annual mean over the whole record weighted by the number of days in each month.
     """
     month_length = data.time.dt.days_in_month
-    weights = month_length.groupby("time.year") / month_length.groupby("time.year").sum()
+    if kernel != "xarray":
+        sums = group_reduce(data, "month", kernel, normalize=False, block_bytes=block_bytes).sum(dim="month")
+    else:
+        sums = (data * month_length).sum(dim="time")
 
-    np.testing.assert_allclose(weights.groupby("time.year").sum().values, np.ones(years))
-
-    ann = (data * weights).groupby("time.year").sum(dim="time")
-    
-    list_of_lists = [lst if isinstance(lst, list) else [lst] for lst in data.lev.values]
-    lev_data = np.unique(np.concatenate(list_of_lists)).tolist()
-    ann['lev'] = lev_data
-    return retain_attr(data, ann)
+    ann = (sums / month_length.sum()).expand_dims("year")
+    return retain_attr(data, attach_lev(data, ann))
 
 
-def mmean(data):
+def mmean(data, kernel="xarray", block_bytes=None):
     """
     Compute monthly mean weighted by the number of days in each month.
     """
+    if kernel != "xarray":
+        return fused_mean(data, "month", kernel, block_bytes)
+
     month_length = data.time.dt.days_in_month
     weights = month_length.groupby("time.month") / month_length.groupby("time.month").sum()
 
     np.testing.assert_allclose(weights.groupby("time.month").sum().values, np.ones(12))
 
     mon = (data * weights).groupby("time.month").sum(dim="time")
-    
-    list_of_lists = [lst if isinstance(lst, list) else [lst] for lst in data.lev.values]
-    lev_data = np.unique(np.concatenate(list_of_lists)).tolist()
-    mon['lev'] = lev_data
-    return retain_attr(data, mon)
+    return retain_attr(data, attach_lev(data, mon))
+
+
+def month_sums(data, kernel="xarray", block_bytes=None):
+    """
+    Sum the data weighted by the number of days in each month, per calendar month.
+    """
+    month_length = data.time.dt.days_in_month
+    if kernel != "xarray":
+        sums = group_reduce(data, "month", kernel, normalize=False, block_bytes=block_bytes)
+    else:
+        sums = (data * month_length).groupby("time.month").sum(dim="time")
+    days = month_length.groupby("time.month").sum()
+    months = range(1, 13)
+    return sums.reindex(month=months, fill_value=0), days.reindex(month=months, fill_value=0)
+
+
+def month_pieces(data, variables):
+    """
+    Sums and numbers of valid samples of sub-monthly data per (year, month), with the first time of each month.
+    """
+    years, months = data["time.year"].values, data["time.month"].values
+    pieces = {}
+    for key in sorted(set(zip(years.tolist(), months.tolist()))):
+        piece = data[variables].isel(time=(years == key[0]) & (months == key[1]))
+        sums = piece.astype(np.float64).sum("time").load()
+        pieces[key] = (sums, piece.notnull().sum("time").load(), piece.time[:1])
+    return pieces
+
+
+def month_stats(data, variables):
+    """
+    Per calendar month: days of the valid samples, days-weighted sum of squared deviations from
+    their mean, minimum, maximum and number of valid samples.
+
+    Deviations are taken from the first sample of each month so that the sum of squares does not
+    cancel when the variability is small compared to the mean.
+    """
+    months, first = np.unique(data["time.month"].values, return_index=True)
+    month_length = data.time.dt.days_in_month
+
+    out = {}
+    for var in variables:
+        values = data[var]
+        ref = values.isel(time=first).fillna(0).assign_coords(time=months).rename({"time": "month"})
+        dev = (values - ref.sel(month=data["time.month"]).drop_vars("month")).astype(np.float64)
+
+        weights = month_length.where(values.notnull(), 0)
+        wgt = weights.groupby("time.month").sum()
+        dev_sum = (dev * weights).groupby("time.month").sum()
+        dev_sq = (dev**2 * weights).groupby("time.month").sum()
+
+        out[f"{var}_wgt"] = wgt
+        out[f"{var}_m2"] = (dev_sq - dev_sum**2 / wgt.where(wgt > 0)).fillna(0).clip(min=0)
+        out[f"{var}_min"] = values.groupby("time.month").min()
+        out[f"{var}_max"] = values.groupby("time.month").max()
+        out[f"{var}_count"] = values.notnull().groupby("time.month").sum()
+
+    months = range(1, 13)
+    return xr.Dataset(out).reindex(month=months).fillna(
+        {name: 0 for name in out if not name.endswith(("_min", "_max"))}
+    )
+
+
+def period_weights(months):
+    """
+    1 where a month (of the given months) belongs to a period of YEAR_PERIODS, else 0.
+    """
+    return xr.DataArray(
+        [[1.0 if period in ("ANN", MONTH_SEASONS[m]) else 0.0 for m in months] for period in YEAR_PERIODS],
+        dims=("year_period", "month"),
+        coords={"year_period": YEAR_PERIODS},
+    )
+
+
+def year_states(psum, pwgt):
+    """
+    States of the yearly means psum / pwgt of each period over the year dimension: days of the valid
+    samples, their days-weighted sum and sum of squared deviations, minimum, maximum and number of years.
+    """
+    valid = pwgt > 0
+    means = psum / pwgt.where(valid)
+    wgt, total = pwgt.sum("year"), psum.sum("year")
+    mean = total / wgt.where(wgt > 0)
+    return {
+        "ywgt": wgt,
+        "ysum": total,
+        "ym2": (pwgt * (means - mean) ** 2).fillna(0).sum("year"),
+        "ymin": means.min("year"),
+        "ymax": means.max("year"),
+        "ycount": valid.sum("year"),
+    }
+
+
+def year_stats(data, variables):
+    """
+    Per annual and seasonal period: states of the days-weighted means of the period in each year.
+    Seasons take the months of one calendar year, like the seasonal means.
+    """
+    month_length = data.time.dt.days_in_month
+    weights = period_weights(data["time.month"].values).rename(month="time").assign_coords(time=data.time)
+
+    out = {}
+    for var in variables:
+        values = data[var].astype(np.float64)
+        days = month_length.where(values.notnull(), 0)
+        psum = (values.fillna(0) * month_length * weights).groupby("time.year").sum()
+        pwgt = (days * weights).groupby("time.year").sum()
+        for state, value in year_states(psum, pwgt).items():
+            out[f"{var}_{state}"] = value
+
+    return xr.Dataset(out)
+
+
+def open_sums(data, variables):
+    """
+    Days-weighted sums and days of the valid samples per calendar month, of the year being read.
+    """
+    month_length = data.time.dt.days_in_month
+    out = {}
+    for var in variables:
+        values = data[var].astype(np.float64)
+        out[f"{var}_osum"] = (values.fillna(0) * month_length).groupby("time.month").sum()
+        out[f"{var}_owgt"] = month_length.where(values.notnull(), 0).groupby("time.month").sum()
+    return xr.Dataset(out).reindex(month=range(1, 13), fill_value=0)
+
+
+def close_year(sums, variables):
+    """
+    Add the year being read (the open states) to the yearly states, and drop the open states.
+    """
+    weights = period_weights(sums.month.values)
+    year = {}
+    for var in variables:
+        psum = xr.dot(sums[f"{var}_osum"], weights, dim="month").expand_dims("year")
+        pwgt = xr.dot(sums[f"{var}_owgt"], weights, dim="month").expand_dims("year")
+        year.update({f"{var}_{state}": value for state, value in year_states(psum, pwgt).items()})
+
+    year = xr.Dataset(year)
+    if f"{variables[0]}_ywgt" in sums:
+        year = merge_year_states(sums, year, variables)
+    opened = [f"{var}_{state}" for var in variables for state in OPEN_STATES]
+    return sums.drop_vars(opened).assign(year)
+
+
+def merge_moments(wa, sa, m2a, wb, sb, m2b):
+    """
+    Weights, weighted sums and sums of squared deviations of two sets of samples combined (Chan et al.).
+    """
+    wgt = wa + wb
+    delta = sb / wb.where(wb > 0) - sa / wa.where(wa > 0)
+    return wgt, sa + sb, m2a + m2b + (delta**2 * wa * wb / wgt).fillna(0)
+
+
+def merge_year_states(a, b, variables):
+    """
+    Yearly states of two disjoint sets of years combined.
+    """
+    out = {}
+    for var in variables:
+        wgt, total, m2 = merge_moments(
+            a[f"{var}_ywgt"], a[f"{var}_ysum"], a[f"{var}_ym2"], b[f"{var}_ywgt"], b[f"{var}_ysum"], b[f"{var}_ym2"]
+        )
+        out.update({f"{var}_ywgt": wgt, f"{var}_ysum": total, f"{var}_ym2": m2})
+        out[f"{var}_ymin"] = xr.apply_ufunc(np.fmin, a[f"{var}_ymin"], b[f"{var}_ymin"], dask="allowed")
+        out[f"{var}_ymax"] = xr.apply_ufunc(np.fmax, a[f"{var}_ymax"], b[f"{var}_ymax"], dask="allowed")
+        out[f"{var}_ycount"] = a[f"{var}_ycount"] + b[f"{var}_ycount"]
+    return xr.Dataset(out)
+
+
+def acc_variables(acc):
+    """
+    Variables accumulated per calendar month, without the statistics states kept for each of them.
+    """
+    names = [var for var in acc.data_vars if "month" in acc[var].dims and var != "month_days"]
+    states = {
+        f"{var}_{state}"
+        for var in names
+        if all(f"{var}_{state}" in names for state in STAT_STATES)
+        for state in STAT_STATES + OPEN_STATES
+    }
+    return [var for var in names if var not in states]
+
+
+def combine_sums(a, b, variables):
+    """
+    Add the days-weighted monthly sums of two sets of samples and merge their statistics (Chan et al.).
+
+    The yearly states are merged when both hold them, and kept from the one that does otherwise; the
+    states of a year being read are kept from a.
+    """
+    out = a[variables] + b[variables]
+    for var in variables:
+        if f"{var}_m2" not in a:
+            continue
+
+        wgt, _, m2 = merge_moments(a[f"{var}_wgt"], a[var], a[f"{var}_m2"], b[f"{var}_wgt"], b[var], b[f"{var}_m2"])
+        out[f"{var}_wgt"] = wgt
+        out[f"{var}_m2"] = m2
+        out[f"{var}_min"] = xr.apply_ufunc(np.fmin, a[f"{var}_min"], b[f"{var}_min"], dask="allowed")
+        out[f"{var}_max"] = xr.apply_ufunc(np.fmax, a[f"{var}_max"], b[f"{var}_max"], dask="allowed")
+        out[f"{var}_count"] = a[f"{var}_count"] + b[f"{var}_count"]
+
+    yearly = [var for var in variables if f"{var}_ywgt" in a or f"{var}_ywgt" in b]
+    if yearly:
+        if all(f"{var}_ywgt" in a and f"{var}_ywgt" in b for var in yearly):
+            out = out.assign(merge_year_states(a, b, yearly))
+        else:
+            held = a if f"{yearly[0]}_ywgt" in a else b
+            out = out.assign({f"{var}_{state}": held[f"{var}_{state}"] for var in yearly for state in YEAR_STATES})
+
+    opened = [f"{var}_{state}" for var in variables for state in OPEN_STATES if f"{var}_{state}" in a]
+    return out.assign({name: a[name] for name in opened})
+
+
+def stats_from_sums(sums, variables, statistics, key):
+    """
+    Days-weighted statistics in each month (of the monthly samples), or in each season or the whole
+    record (key = year; of the yearly seasonal or annual means). Variances are population variances:
+    the sum of squared deviations divided by the total weight.
+    """
+    if key != "month":
+        periods = sorted(set(MONTH_SEASONS[m] for m in sums.month.values)) if key == "season" else ["ANN"]
+        yearly = sums.sel(year_period=periods).rename(year_period=key)
+
+    out = {}
+    for var in variables:
+        if key == "month":
+            wgt, m2 = sums[f"{var}_wgt"], sums[f"{var}_m2"]
+            values = {"min": sums[f"{var}_min"], "max": sums[f"{var}_max"], "count": sums[f"{var}_count"]}
+        else:
+            wgt, m2 = yearly[f"{var}_ywgt"], yearly[f"{var}_ym2"]
+            values = {"min": yearly[f"{var}_ymin"], "max": yearly[f"{var}_ymax"], "count": yearly[f"{var}_ycount"]}
+
+        variance = m2 / wgt.where(wgt > 0)
+        values.update({"std": np.sqrt(variance), "var": variance, "count": values["count"].astype(np.int32)})
+        for stat in statistics:
+            out[f"{var}_{stat}"] = values[stat].assign_attrs(stat_attrs(var, sums[var].attrs, stat, key))
+
+    out = xr.Dataset(out)
+    return out.drop_vars(key) if key == "year" else out
+
+
+def stat_attrs(var, attrs, stat, key="month"):
+    """
+    Attributes of a statistic of a variable.
+    """
+    attrs = dict(attrs)
+    name = attrs.get("long_name", var)
+    attrs["cell_methods"] = f"time: {STAT_METHODS[stat]}"
+    if stat == "count":
+        samples = "valid samples" if key == "month" else "years with valid samples"
+        attrs.update(units="1", long_name=f"number of {samples} of {name}")
+        return attrs
+
+    attrs["long_name"] = f"{STAT_METHODS[stat].replace('_', ' ')} of {name}"
+    if key != "month":
+        attrs["long_name"] += f" ({'annual' if key == 'year' else 'seasonal'} means)"
+    if stat == "var" and "units" in attrs:
+        attrs["units"] = f"({attrs['units']})^2"
+    return attrs
+
+
+def smean_from_mmean(mon, mdays):
+    """
+    Compute seasonal means from monthly means weighted by the days in each month.
+    """
+    season = xr.DataArray(
+        [MONTH_SEASONS[m] for m in mon.month.values],
+        dims="month",
+        coords={"month": mon.month},
+        name="season",
+    )
+    weights = mdays.groupby(season) / mdays.groupby(season).sum()
+
+    seasons = (mon * weights).groupby(season).sum(dim="month")
+    return retain_attr(mon, seasons)
+
+
+def amean_from_mmean(mon, mdays):
+    """
+    Compute the annual mean over the record from monthly means weighted by the days in each month.
+    """
+    weights = mdays / mdays.sum()
+
+    ann = (mon * weights).sum(dim="month").expand_dims("year")
+    return retain_attr(mon, ann)
+
+
+def get_years(flist):
+    """
+    Extract the simulated years from the file names.
+    """
+    years = []
+    for filename in flist:
+        filename = str(filename).split("/")[-1]
+        match = re.search(r"h?\.(\d{4}).*\.nc$", filename)
+        if match:
+            years.append(int(match.group(1)))
+
+    return np.sort(list(set(years)))
+
+
+def case_path(path, case):
+    """
+    Directory of a case: {case} in the path is replaced by the case name.
+    """
+    return path.replace("{case}", case) if path is not None else None
+
+
+def expand_cases(cases, path=None, mod="eam", stream="h0"):
+    """
+    Case names from a comma separated list; names with wildcards are matched against the cases
+    with history files in the input directory (or the directories matching a {case} path).
+    """
+    names = []
+    for pattern in [x.strip() for x in cases.split(",") if x.strip()]:
+        if not any(char in pattern for char in "*?["):
+            names.append(pattern)
+            continue
+
+        if path is not None and "{case}" in path:
+            regex = re.compile(re.escape(path).replace(re.escape("{case}"), "(.+?)") + "/?$")
+            matches = [regex.match(x).group(1) for x in glob.glob(case_path(path, pattern))]
+        else:
+            found = get_dir_path(path or "").glob(f"{pattern}.{mod}.{stream}.*")
+            matches = [x.name.split(f".{mod}.{stream}.")[0] for x in found]
+
+        if not matches:
+            raise ValueError(f"No case matches {pattern}")
+        names.extend(sorted(set(matches)))
+
+    return list(dict.fromkeys(names))
+
+
+def is_zarr(path):
+    """
+    Check whether the path is a Zarr store.
+    """
+    path = Path(path)
+    return path.suffix == ".zarr" or any((path / name).exists() for name in [".zgroup", "zarr.json"])
+
+
+def open_input(filename, **kwargs):
+    """
+    Open an input NetCDF file or Zarr store.
+    """
+    if is_zarr(filename):
+        return xr.open_zarr(filename, **kwargs)
+    return xr.open_dataset(filename, **kwargs)
+
+
+def stamped_at_end(data):
+    """
+    Check whether monthly time stamps mark the end of the averaging period, as in EAM h0 files.
+    """
+    bounds = time_bounds(data)
+    if bounds is not None and bounds.dtype == data.time.dtype:
+        return bool((data.time == bounds.isel({bounds.dims[-1]: -1})).all())
+
+    return bool(((data.time.dt.day == 1) & (data.time.dt.hour == 0)).all())
 
 
 def get_dir_path(path):
@@ -110,6 +644,65 @@ def get_dir_path(path):
     """
     return Path(".").absolute() if path == "" else Path(path)
 
+
+def nc_encoding(data, compression="zlib", complevel=1, shuffle=True, dtypes=None):
+    """
+    NetCDF encoding of the data variables: compression, one level by all columns per chunk and input dtypes.
+
+    netCDF4 applies the shuffle filter with zlib only: it is left out with zstd.
+    """
+    encoding = {}
+    for var in data.data_vars:
+        var_encoding = {}
+        if compression != "none" and data[var].ndim > 0:
+            var_encoding.update({"zlib": True} if compression == "zlib" else {"compression": compression})
+            var_encoding.update({
+                "complevel": complevel,
+                "chunksizes": tuple(1 if dim in ["time", "lev"] else size for dim, size in data[var].sizes.items()),
+            })
+            if compression == "zlib":
+                var_encoding["shuffle"] = shuffle
+
+        # The weighted means are float64; write them back in the dtype they were read in
+        if dtypes is not None and var in dtypes and dtypes[var] != data[var].dtype:
+            var_encoding["dtype"] = dtypes[var]
+
+        encoding[var] = var_encoding
+
+    return encoding
+
+
+def start_scheduler(scheduler="threads", workers=None, threads_per_worker=None, memory_limit=None, shared=False):
+    """
+    Configure the dask scheduler; returns the client when a local distributed cluster is started.
+
+    With shared, computes started from several threads (one per case) run on a single pool of
+    workers instead of one pool each.
+    """
+    if scheduler == "distributed":
+        from dask.distributed import Client, LocalCluster
+
+        cluster = LocalCluster(
+            n_workers=workers,
+            threads_per_worker=threads_per_worker,
+            memory_limit=memory_limit if memory_limit is not None else "auto",
+        )
+        client = Client(cluster)
+        print("\nStarted local dask cluster:", client.dashboard_link)
+        return client
+
+    dask.config.set(scheduler=scheduler, num_workers=workers)
+    if shared and scheduler == "threads":
+        dask.config.set(pool=ThreadPoolExecutor(workers or os.cpu_count()))
+    elif shared and scheduler == "processes":
+        from dask.multiprocessing import get_context, initialize_worker_process
+
+        pool = ProcessPoolExecutor(workers or os.cpu_count(), mp_context=get_context(), initializer=initialize_worker_process)
+        dask.config.set(pool=pool)
+    print(f"\nUsing the dask '{scheduler}' scheduler.")
+    return None
+
+
 def exec_shell(cmd):
     """
     Execute a shell command and return the output.
@@ -119,42 +712,176 @@ def exec_shell(cmd):
     output, _ = process.communicate()
     return output
 
-def prep_mamxx(data):
+MAMXX_TRACERS = [
+    "Q", "CLDLIQ", "CLDICE", "NUMLIQ", "NUMICE", "RAINQM", "SNOWQM",
+    "NUMRAI", "NUMSNO", "O3", "H2O2", "H2SO4", "SO2", "DMS", "SOAG",
+    "so4_a1", "pom_a1", "soa_a1", "bc_a1", "dst_a1", "ncl_a1", "mom_a1", "num_a1",
+    "so4_a2", "soa_a2", "ncl_a2", "mom_a2", "num_a2",
+    "dst_a3", "ncl_a3", "so4_a3", "bc_a3", "pom_a3", "soa_a3", "mom_a3", "num_a3",
+    "pom_a4", "bc_a4", "mom_a4", "num_a4"
+]
+
+MAMXX_MWS = {'num':1.0074, 'bc':12.011, 'pom':12.011, 'H2O2':34.0136, 
+             'O3':47.9982, 'ncl': 58.442468, 'DMS':62.1324, 'SO2':64.0648, 
+             'H2SO4':98.0784, 'so4':115.10734, 'dst':135.064039, 
+             'mom':250092.672, 'SOAG':12.011, 'soa':12.011
+             }
+
+MAMXX_MWDRY = 28.966
+
+MAMXX_GVARS = ['SO2', 'DMS', 'H2SO4', 'SOAG']
+
+MAMXX_EXTFRC = ["so2",    "so4_a1", "so4_a2", "pom_a4", "bc_a4",
+                "num_a1", "num_a2", "num_a4", "soag"]
+
+MAMXX_AEROSOLS = ['bc', 'so4', 'dst', 'mom', 'pom', 'ncl', 'soa', 'num', 'DMS', 'SO2', 'H2SO4']
+
+MAMXX_MODES = ['1', '2', '3', '4']
+
+# Optical properties derived from more than one EAMxx variable
+MAMXX_OPTICS = {
+    "AODVIS": ["aero_tau_sw", "aero_ssa_sw"],
+    "SSAVIS": ["aero_tau_sw", "aero_ssa_sw"],
+    "AODABS": ["aero_tau_sw", "aero_ssa_sw"],
+}
+
+
+def mamxx_table():
     """
-    Pre-process EAMxx outputs to EAM: active when using SCREAM.
+    Map each EAM name derived from EAMxx outputs to (source variable, packed dimension, index, factor).
     """
-    tracers = [
-        "Q", "CLDLIQ", "CLDICE", "NUMLIQ", "NUMICE", "RAINQM", "SNOWQM",
-        "NUMRAI", "NUMSNO", "O3", "H2O2", "H2SO4", "SO2", "DMS", "SOAG",
-        "so4_a1", "pom_a1", "soa_a1", "bc_a1", "dst_a1", "ncl_a1", "mom_a1", "num_a1",
-        "so4_a2", "soa_a2", "ncl_a2", "mom_a2", "num_a2",
-        "dst_a3", "ncl_a3", "so4_a3", "bc_a3", "pom_a3", "soa_a3", "mom_a3", "num_a3",
-        "pom_a4", "bc_a4", "mom_a4", "num_a4"
-    ]
-
-    MWs = {'num':1.0074, 'bc':12.011, 'pom':12.011, 'H2O2':34.0136, 
-           'O3':47.9982, 'ncl': 58.442468, 'DMS':62.1324, 'SO2':64.0648, 
-           'H2SO4':98.0784, 'so4':115.10734, 'dst':135.064039, 
-           'mom':250092.672, 'SOAG':12.011, 'soa':12.011
-           }
-    
-    mwdry = 28.966
+    tracers = {tracer: i for i, tracer in enumerate(MAMXX_TRACERS)}
+    gas_aerosols = {tracer: i for i, tracer in enumerate(MAMXX_TRACERS[-31:])}
+    phys, gas_aer = "num_phys_constituents", "num_gas_aerosol_constituents"
+    table = {}
+
+    # Aerosol species
+    for aer in MAMXX_AEROSOLS:
+        micFact = MAMXX_MWS[aer] / MAMXX_MWDRY
+        sources = [
+            (['a', 'c'], ['aerdepwetis', 'aerdepwetcw'], "{aer}_{aval}{mode}SFWET", phys, 1.0),
+            (['a', 'c'], ['deposition_flux_of_interstitial_aerosols',
+                          'deposition_flux_of_cloud_borne_aerosols'], "{aer}_{aval}{mode}DDF", phys, 1.0),
+            (['a'], ['constituent_fluxes'], "SF{aer}_{aval}{mode}", phys, 1.0),
+            (['a'], ['mam4_microphysics_tendency_condensation_vert_sum_dp_weighted'],
+             "{aer}_{aval}{mode}_sfgaex1", gas_aer, micFact),
+            (['a'], ['mam4_microphysics_tendency_coagulation_vert_sum_dp_weighted'],
+             "{aer}_{aval}{mode}_sfcoag1", gas_aer, micFact),
+            (['a'], ['mam4_microphysics_tendency_nucleation_vert_sum_dp_weighted'],
+             "{aer}_{aval}{mode}_sfnnuc1", gas_aer, micFact),
+            (['a', 'c'], ['mam4_microphysics_tendency_renaming_vert_sum_dp_weighted',
+                          'mam4_microphysics_tendency_renaming_cloud_borne_vert_sum_dp_weighted'],
+             "{aer}_{aval}{mode}_sfgaex2", gas_aer, micFact),
+        ]
+        for avals, vnames, name, dim, factor in sources:
+            index = tracers if dim == phys else gas_aerosols
+            for aval, vname in zip(avals, vnames):
+                for mode in MAMXX_MODES:
+                    if f"{aer}_a{mode}" in index:
+                        var_name = name.format(aer=aer, aval=aval, mode=mode)
+                        table[var_name] = (vname, dim, index[f"{aer}_a{mode}"], factor)
 
-    gvars = ['SO2', 'DMS', 'H2SO4', 'SOAG']
-    
-    extfrc_lst = ["so2",    "so4_a1", "so4_a2", "pom_a4", "bc_a4",
-                  "num_a1", "num_a2", "num_a4", "soag"]
-
-    # Define default chunk sizes (adjustable based on dataset size)
-    default_chunks = {
-        "lev": -1,
-        "ncol": -1,
-        "lat": -1,
-        "lon": -1,
-    }
+    # Gas-species
+    vnames = ['aerdepwetis', 'deposition_flux_of_interstitial_aerosols', 'constituent_fluxes',
+              'mam4_microphysics_tendency_condensation_vert_sum_dp_weighted',
+              'mam4_microphysics_tendency_nucleation_vert_sum_dp_weighted']
+    tags = ['WD_', 'DF_', 'SF', '_sfgaex1', '_sfnnuc1']
+    for vname, tag in zip(vnames, tags):
+        for gvar in MAMXX_GVARS:
+            if vname.startswith("mam4_microphysics"):
+                table[f"{tag}{gvar}"] = (vname, gas_aer, gas_aerosols[gvar], 1.0)
+            else:
+                table[f"{tag}{gvar}"] = (vname, phys, tracers[gvar], 1.0)
+
+    # External forcings (elevated emissions)
+    for vname, suffix in [('mam4_external_forcing', 'XFRC'),
+                          ('mam4_external_forcing_vert_sum_dz_weighted', 'CLXF')]:
+        for i, extfrc_var in enumerate(MAMXX_EXTFRC):
+            var_name = f"{extfrc_var}_{suffix}"
+            if extfrc_var.upper() in MAMXX_GVARS:
+                var_name = var_name.upper()
+            table[var_name] = (vname, "ext_cnt", i, 1.0)
+
+    # Cloud chemistry
+    for vname, suffix in [('dqdt_h2so4_uptake', 'AQH2SO4'), ('dqdt_so4_aqueous_chemistry', 'AQSO4')]:
+        for mode in MAMXX_MODES:
+            if f"so4_a{mode}" in tracers:
+                table[f"so4_c{mode}{suffix}"] = (vname, "nmodes", int(mode) - 1, 1.0)
+
+    # Dry and wet size, aerosol water
+    size_vars = {'dgnum': 'dgnd_a0', 'dgnumwet': 'dgnw_a0', 'qaerwat': 'wat_a'}
+    for vname, item in size_vars.items():
+        for mode in MAMXX_MODES:
+            table[f"{item}{mode}"] = (vname, "nmodes", int(mode) - 1, 1.0)
+
+    # ACI diagnostics
+    ccn_vars = ["ccn_0p02", "ccn_0p05", "ccn_0p1", "ccn_0p2", "ccn_0p5", "ccn_1p0"]
+    for i, vname in enumerate(ccn_vars):
+        table[f'CCN{i+1}'] = (vname, None, None, 1.0)
+
+    return table
+
+
+MAMXX_TABLE = mamxx_table()
+
+
+def mamxx_name(var):
+    """
+    EAM name of an EAMxx output variable after the renaming done in prep_mamxx.
+    """
+    var = {'ps': 'PS', 'landfrac': 'LANDFRAC'}.get(var, var.replace("nacl", "ncl"))
+    return var.replace("_pg2", "").replace("pg2", "")
+
+
+def mamxx_sources(variables):
+    """
+    EAMxx source variables needed to derive the given EAM variables.
+    """
+    sources = set()
+    for var in variables:
+        if var in MAMXX_TABLE:
+            sources.add(MAMXX_TABLE[var][0])
+        sources.update(MAMXX_OPTICS.get(var, []))
+
+    return sources
+
+
+def split_packed(packed, dim, entries):
+    """
+    Split a packed EAMxx variable into EAM variables with a single gather along its packed dimension.
+    """
+    names = [name for name, _, _ in entries]
+    if dim is None:
+        return {name: packed for name in names}
+
+    split = packed.isel({dim: [index for _, index, _ in entries]})
+
+    factors = np.array([factor for _, _, factor in entries], dtype=packed.dtype)
+    if (factors != 1).any():
+        split = split * xr.DataArray(factors, dims=dim)
+
+    split = split.assign_coords({dim: names}).to_dataset(dim=dim)
+    for name, factor in zip(names, factors):
+        split[name].attrs = packed.attrs.copy() if factor == 1 else {}
+
+    return dict(split.data_vars)
+
+
+def prep_mamxx(data, variables=None, chunks=None):
+    """
+    Pre-process EAMxx outputs to EAM: active when using SCREAM.
+    """
+    # Whole levels and columns unless a chunk plan is given
+    if chunks is None:
+        chunks = {
+            "lev": -1,
+            "ncol": -1,
+            "lat": -1,
+            "lon": -1,
+        }
 
     # Only apply chunking to existing dimensions
-    chunk_dims = {dim: default_chunks[dim] for dim in default_chunks if dim in data.dims}
+    chunk_dims = {dim: chunks[dim] for dim in chunks if dim in data.dims and dim != "time"}
     data = data.chunk(chunk_dims)
 
     # Get available spatial dimensions
@@ -172,143 +899,26 @@ def prep_mamxx(data):
         rename_dict.update({'landfrac':'LANDFRAC'})
     data = data.rename(rename_dict)
 
-    aer_list = ['bc', 'so4', 'dst', 'mom', 'pom', 'ncl', 'soa', 'num', 'DMS', 'SO2', 'H2SO4']
-    new_vars = {}
-
-    # Aerosol processing
-    for aer in aer_list:
-        micFact = MWs[aer] / mwdry
-        for aval, vname in zip(['a', 'c'], ['aerdepwetis', 'aerdepwetcw']):
-            for mode in ['1', '2', '3', '4']:
-                var_name = f"{aer}_{aval}{mode}SFWET"
-                if vname in data and f"{aer}_a{mode}" in tracers:
-                    new_vars[var_name] = data[vname].isel(
-                        num_phys_constituents=tracers.index(f"{aer}_a{mode}")
-                    )
-
-        for aval, vname in zip(['a', 'c'], [
-            'deposition_flux_of_interstitial_aerosols',
-            'deposition_flux_of_cloud_borne_aerosols'
-        ]):
-            for mode in ['1', '2', '3', '4']:
-                var_name = f"{aer}_{aval}{mode}DDF"
-                if vname in data and f"{aer}_a{mode}" in tracers:
-                    new_vars[var_name] = data[vname].isel(
-                        num_phys_constituents=tracers.index(f"{aer}_a{mode}")
-                    )
-
-        for aval, vname in zip(['a'], ['constituent_fluxes']):
-            for mode in ['1', '2', '3', '4']:
-                var_name = f"SF{aer}_{aval}{mode}"
-                if vname in data and f"{aer}_a{mode}" in tracers:
-                    new_vars[var_name] = data[vname].isel(
-                        num_phys_constituents=tracers.index(f"{aer}_a{mode}")
-                    )
-
-        for aval, vname in zip(['a'], ['mam4_microphysics_tendency_condensation_vert_sum_dp_weighted']):
-            for mode in ['1', '2', '3', '4']:
-                var_name = f"{aer}_{aval}{mode}_sfgaex1"
-                if vname in data and f"{aer}_a{mode}" in tracers[-31:]:
-                    new_vars[var_name] = data[vname].isel(
-                        num_gas_aerosol_constituents=tracers[-31:].index(f"{aer}_a{mode}")
-                    ) * micFact
-
-        for aval, vname in zip(['a'], ['mam4_microphysics_tendency_coagulation_vert_sum_dp_weighted']):
-            for mode in ['1', '2', '3', '4']:
-                var_name = f"{aer}_{aval}{mode}_sfcoag1"
-                if vname in data and f"{aer}_a{mode}" in tracers[-31:]:
-                    new_vars[var_name] = data[vname].isel(
-                        num_gas_aerosol_constituents=tracers[-31:].index(f"{aer}_a{mode}")
-                    ) * micFact
-
-        for aval, vname in zip(['a'], ['mam4_microphysics_tendency_nucleation_vert_sum_dp_weighted']):
-            for mode in ['1', '2', '3', '4']:
-                var_name = f"{aer}_{aval}{mode}_sfnnuc1"
-                if vname in data and f"{aer}_a{mode}" in tracers[-31:]:
-                    new_vars[var_name] = data[vname].isel(
-                        num_gas_aerosol_constituents=tracers[-31:].index(f"{aer}_a{mode}")
-                    ) * micFact
-
-        for aval, vname in zip(['a','c'], ['mam4_microphysics_tendency_renaming_vert_sum_dp_weighted','mam4_microphysics_tendency_renaming_cloud_borne_vert_sum_dp_weighted']):
-            for mode in ['1', '2', '3', '4']:
-                var_name = f"{aer}_{aval}{mode}_sfgaex2"
-                if vname in data and f"{aer}_a{mode}" in tracers[-31:]:
-                    new_vars[var_name] = data[vname].isel(
-                        num_gas_aerosol_constituents=tracers[-31:].index(f"{aer}_a{mode}")
-                    ) * micFact
-
-    # Gas-species
-    vnames = ['aerdepwetis','deposition_flux_of_interstitial_aerosols','constituent_fluxes',
-                'mam4_microphysics_tendency_condensation_vert_sum_dp_weighted',
-                'mam4_microphysics_tendency_nucleation_vert_sum_dp_weighted']
-    tags = ['WD_','DF_','SF','_sfgaex1','_sfnnuc1']
-    for vname, tag in zip(vnames,tags):
-        for gvar in gvars:
-            var_name = f"{tag}{gvar}"
-            if vname in data and f"{gvar}" in tracers:
-                try:
-                    new_vars[var_name] = data[vname].isel(
-                        num_phys_constituents=tracers.index(f"{gvar}")
-                    )
-                except:
-                    new_vars[var_name] = data[vname].isel(
-                        num_gas_aerosol_constituents=tracers[-31:].index(f"{gvar}")
-                    )
-
-    # External forcings (elevated emissions)
-    vname = 'mam4_external_forcing'
-    for extfrc_var in extfrc_lst:
-        var_name = f"{extfrc_var}_XFRC"
-        if extfrc_var.upper() in gvars:
-            var_name = var_name.upper()
-        if vname in data and f"{extfrc_var}" in extfrc_lst:
-            new_vars[var_name] = data[vname].isel(
-                        ext_cnt=extfrc_lst.index(f"{extfrc_var}")
-                    )
-
-    vname = 'mam4_external_forcing_vert_sum_dz_weighted'
-    for extfrc_var in extfrc_lst:
-        var_name = f"{extfrc_var}_CLXF"
-        if extfrc_var.upper() in gvars:
-            var_name = var_name.upper()
-        if vname in data and f"{extfrc_var}" in extfrc_lst:
-            new_vars[var_name] = data[vname].isel(
-                        ext_cnt=extfrc_lst.index(f"{extfrc_var}")
-                    )
-    
-    # Cloud chemistry
-    vname = 'dqdt_h2so4_uptake'
-    aer = 'so4'
-    if vname in data:
-        for mode in ['1', '2', '3', '4']:
-            if f"{aer}_a{mode}" in tracers:
-                var_name = f"{aer}_c{mode}AQH2SO4"
-                new_vars[var_name] = data[vname].isel(nmodes=int(mode) - 1)
-
-    vname = 'dqdt_so4_aqueous_chemistry'
-    aer = 'so4'
-    if vname in data:
-        for mode in ['1', '2', '3', '4']:
-            if f"{aer}_a{mode}" in tracers:
-                var_name = f"{aer}_c{mode}AQSO4"
-                new_vars[var_name] = data[vname].isel(nmodes=int(mode) - 1)
+    # Group the derived variables by the packed variable they come from
+    table = {
+        name: entry
+        for name, entry in MAMXX_TABLE.items()
+        if variables is None or name in variables
+    }
+    groups = {}
+    for name, (vname, dim, index, factor) in table.items():
+        groups.setdefault((vname, dim), []).append((name, index, factor))
 
-    # Dry and wet size, aerosol water
-    size_vars = {'dgnum': 'dgnd_a0', 'dgnumwet': 'dgnw_a0', 'qaerwat': 'wat_a'}
-    for vname, item in size_vars.items():
+    new_vars = {}
+    for (vname, dim), entries in groups.items():
         if vname in data:
-            for mode in ['1', '2', '3', '4']:
-                var_name = f"{item}{mode}"
-                new_vars[var_name] = data[vname].isel(nmodes=int(mode) - 1)
+            new_vars.update(split_packed(data[vname], dim, entries))
 
-    # ACI diagnostics
-    ccn_vars = ["ccn_0p02", "ccn_0p05", "ccn_0p1", "ccn_0p2", "ccn_0p5", "ccn_1p0"]
-    for i, vname in enumerate(ccn_vars):
-        if vname in data:
-            new_vars[f'CCN{i+1}'] = data[vname]
+    new_vars = {name: new_vars[name] for name in table if name in new_vars}
 
     # Optical properties
-    if {'aero_tau_sw', 'aero_ssa_sw'}.issubset(data.variables):
+    optics = variables is None or any(var in variables for var in MAMXX_OPTICS)
+    if optics and {'aero_tau_sw', 'aero_ssa_sw'}.issubset(data.variables):
         new_vars.update({
             "AODVIS": data['aero_tau_sw'].isel(swband=10).sum(dim='lev'),
             "SSAVIS": data['aero_ssa_sw'].isel(swband=10).sum(dim='lev'),
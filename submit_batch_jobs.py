@@ -1,6 +1,13 @@
+import os
+import json
+import hashlib
+import math
 import configparser
 
-from src.utils import exec_shell
+from pathlib import Path
+from dask.utils import parse_bytes
+
+from src.utils import exec_shell, expand_cases, case_path
 
 # Load configuration file
 config = configparser.ConfigParser(allow_no_value=True)
@@ -17,19 +24,114 @@ end = config.get("CMD", "end")
 in_directory = config.get("CMD", "inDirectory")
 out_directory = config.get("CMD", "outDirectory")
 model = config.get("CMD", "model")
-variables = config.get("CMD", "variables")
+variables = (config.get("CMD", "variables") or "").replace(" ", "")
 genclimo_dir = config.get("CMD", "genclimoDir")
 walltime = config.get("CMD", "walltime")
+time_freq = config.get("CMD", "timeFreq", fallback=None) or "all"
+statistics = config.get("CMD", "statistics", fallback=None)
+regions = config.get("CMD", "regions", fallback=None)
+stream = config.get("CMD", "stream", fallback=None) or "h0"
+concurrent_cases = config.get("CMD", "concurrentCases", fallback=None)
+
+# Optional dask execution settings passed through to genclimo.py
+dask_options = {
+    "scheduler": "--scheduler",
+    "workers": "--workers",
+    "threadsPerWorker": "--threads-per-worker",
+    "memoryLimit": "--memory-limit",
+}
+options = []
+for key, flag in dask_options.items():
+    value = config.get("DASK", key, fallback=None)
+    if value:
+        options.append(f"{flag} {value}")
+if stream != "h0":
+    options.append(f"--stream {stream}")
+if concurrent_cases:
+    options.append(f"--concurrent-cases {concurrent_cases}")
+
+
+# Options the merge job of a job array needs as well
+climo_options = []
+if statistics:
+    climo_options.append(f"--stats {statistics.replace(' ', '')}")
+if regions:
+    climo_options.append(f"--regions {regions.replace(' ', '')}")
+
+# Jobs killed at their walltime are resubmitted to resume from their checkpoint
+resubmit = int(config.get("BATCH", "resubmit", fallback=None) or 0)
+if resubmit:
+    climo_options.append("--resume")
+options += climo_options
+
+var_groups = config.get("ARRAY", "varGroups", fallback=None) or "1"
+year_groups = int(config.get("ARRAY", "yearGroups", fallback=None) or 1)
+node_memory = config.get("BATCH", "nodeMemory", fallback=None)
+
+# Margin over the estimated runtime and shortest walltime of the automatic walltime
+WALLTIME_MARGIN = 2
+MIN_WALLTIME = 10 * 60
 
 
 # Default output directory to input directory if not specified
 if out_directory is None:
     out_directory = in_directory
 
-# Loop through different time periods
-for time_period in ["ann", "sea", "mon"]:
-    script_path = f"{out_directory}/get_climoPy_{time_period}.sh"
-    exec_shell(f"cp {genclimo_dir}/src/batch_script/get_climoPy_batch.sh {script_path}")
+# Case patterns are resolved now so that every job processes the same cases
+cases = expand_cases(case, in_directory, model, stream)
+case = ",".join(cases)
+print(f"Cases: {case}")
+
+# Scripts and logs go to the output directory (of the first case when it depends on the case)
+job_dir = case_path(out_directory, cases[0])
+
+
+def dry_run():
+    """
+    Plans of every case from a dry run of genclimo on this node, for the memory of a batch node.
+    """
+    if node_memory:
+        os.environ["SLURM_MEM_PER_NODE"] = str(parse_bytes(node_memory) // 2**20)
+
+    cmd = [
+        f"python {genclimo_dir}/genclimo.py -c {case} -s {start} -e {end}",
+        f"-indir {in_directory} -outdir {out_directory} -m {model}",
+        f"-v {variables}" if variables else "",
+        "-t all --plan",
+    ]
+    print(exec_shell(" ".join([x for x in cmd + options if x])))
+
+    plans = []
+    for name in cases:
+        with open(Path(case_path(out_directory, name)) / f"{name}_{start}01_{end}12_genclimo_plan.json") as file:
+            plans.append(json.load(file))
+    return plans
+
+
+if walltime == "auto" or var_groups == "auto":
+    plans = dry_run()
+
+    # Variable groups split the monthly sums and climos kept in memory over as many nodes;
+    # the merge job streams them from the task accumulators period by period
+    if var_groups == "auto":
+        peak = max(plan["peak_memory_bytes"] for plan in plans)
+        var_groups = max(math.ceil(peak / plans[0]["memory_bytes"]), 1)
+        print(f"Variable groups from the dry run: {var_groups}")
+
+    if walltime == "auto":
+        seconds = sum(plan["runtime"]["total_s"] for plan in plans) / (int(var_groups) * year_groups)
+        seconds = max(math.ceil(seconds * WALLTIME_MARGIN / 60) * 60, MIN_WALLTIME)
+        walltime = f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:00"
+        print(f"Walltime from the dry run: {walltime}")
+
+var_groups = int(var_groups)
+
+
+def write_script(template, script_path, time_period, extra_options):
+    """
+    Copy a batch script template and fill in the configuration.
+    """
+    exec_shell(f"cp {genclimo_dir}/src/batch_script/{template} {script_path}")
 
     # Read and modify the script template
     with open(script_path, "r") as file:
@@ -37,6 +139,7 @@ for time_period in ["ann", "sea", "mon"]:
 
     file_data = file_data.replace("<account>", account)
     file_data = file_data.replace("<partition>", partition)
+    file_data = file_data.replace("<jobDir>", job_dir)
     file_data = file_data.replace("<source>", source)
 
     if env:
@@ -50,6 +153,7 @@ for time_period in ["ann", "sea", "mon"]:
     file_data = file_data.replace("<outDir>", out_directory)
     file_data = file_data.replace("<model>", model)
     file_data = file_data.replace("<wallMin>", walltime)
+    file_data = file_data.replace("<options>", " ".join(extra_options))
 
     if variables:
         file_data = file_data.replace("<vars>", variables)
@@ -65,5 +169,73 @@ for time_period in ["ann", "sea", "mon"]:
     with open(script_path, "w") as file:
         file.write(file_data)
 
-    # Submit the batch script
-    exec_shell(f"sbatch {script_path}")
\ No newline at end of file
+
+def year_ranges(first, last, ngroups):
+    """
+    Split the years first..last into ngroups contiguous ranges.
+    """
+    years = list(range(int(first), int(last) + 1))
+    size, extra = divmod(len(years), ngroups)
+    ranges, i = [], 0
+    for group in range(min(ngroups, len(years))):
+        n = size + (group < extra)
+        ranges.append((years[i], years[i + n - 1]))
+        i += n
+    return ranges
+
+
+if var_groups * year_groups > 1:
+    # One job-array task per (year range, variable group), each writing its accumulator. Every
+    # submission has its own directory, so that accumulators of earlier ones are never merged
+    submission = [case, start, end, in_directory, model, variables, var_groups, year_groups] + options
+    key = hashlib.sha1(json.dumps(submission).encode()).hexdigest()[:12]
+    groups_dir = f"{out_directory}/genclimo_groups/{key}"
+    for name in cases:
+        Path(case_path(groups_dir, name)).mkdir(parents=True, exist_ok=True)
+
+    tasks = []
+    for first, last in year_ranges(start, end, year_groups):
+        for group in range(var_groups):
+            task = [
+                f"-c {case} -s {str(first).zfill(len(start))} -e {str(last).zfill(len(start))}",
+                f"-indir {in_directory} -outdir {groups_dir} -m {model}",
+                f"-v {variables}" if variables else "",
+                f"-t all --acc-only --group {group} --ngroups {var_groups}",
+            ]
+            tasks.append(" ".join([x for x in task + options if x]))
+
+    with open(f"{job_dir}/genclimo_tasks.txt", "w") as file:
+        file.write("\n".join(tasks) + "\n")
+
+    script_path = f"{job_dir}/get_climoPy_array.sh"
+    write_script("get_climoPy_array.sh", script_path, "all", options)
+    with open(script_path, "r") as file:
+        file_data = file.read().replace("<lastTask>", str(len(tasks) - 1))
+    with open(script_path, "w") as file:
+        file.write(file_data)
+
+    array_id = exec_shell(f"sbatch --parsable {script_path}").strip()
+    print(f"Submitted job array {array_id} with {len(tasks)} tasks")
+
+    # The merge job combines the task accumulators into the usual climo files
+    script_path = f"{job_dir}/get_climoPy_merge.sh"
+    write_script("get_climoPy_batch.sh", script_path, "all", ["--merge", f"--groups-dir {groups_dir}"] + climo_options)
+    print(exec_shell(f"sbatch --dependency=afterok:{array_id} {script_path}"))
+
+else:
+    # Loop through different time periods (a single job when timeFreq = all)
+    for time_period in [x.strip() for x in time_freq.split(",")]:
+        script_path = f"{job_dir}/get_climoPy_{time_period}.sh"
+        write_script("get_climoPy_batch.sh", script_path, time_period, options)
+
+        # Submit the batch script
+        job_ids = [exec_shell(f"sbatch --parsable {script_path}").strip()]
+        print(f"Submitted job {job_ids[0]} ({time_period})")
+
+        # Each resubmission only runs when every earlier job failed, e.g. ran out of time
+        for _ in range(resubmit):
+            dependency = ":".join(job_ids)
+            job_ids.append(exec_shell(
+                f"sbatch --parsable --kill-on-invalid-dep=yes --dependency=afternotok:{dependency} {script_path}"
+            ).strip())
+            print(f"Submitted resubmission {job_ids[-1]} (after {dependency} fails)")